@@ -4,20 +4,40 @@
 The program will run to find all possible solutions, printing each as found.
 
 Modify this file to specify the given row/column counts, ships and staring
-grid.  This program does not handle initial partial ships.
+grid.  Ship hints in the grid (see the key below) are hard constraints:
+every hint cell is covered by a ship that fits it.
+
+To solve many puzzles, pass a puzzle file or a directory of them.  Each line
+of a puzzle file is a JSON puzzle, e.g.
+  {"name": "sample", "rows": [4, 2, 3, 3, "U", "U", 3, 3],
+   "cols": [4, 3, 1, 2, 2, 1, 3, 4], "ships": [4, 3, 3, 2, 2, 2, 1, 1, 1, 1],
+   "grid": ["--w--w--", "--------", ...]}
+Unknown counts are "U" or null, and the grid uses the key below.  "name" and
+"grid" are optional.  One JSON line per puzzle is written with its solutions
+and the seconds taken, as each puzzle finishes.
 """
 
-# TODO: Handle initial partial ships
-#   The current implementation assumes that a ship can go any place not
-#     explicitly marked as water. This breaks with partial ships because
-#     one adjacent direction could be a ship, but not both.
-#     Issue?  Placing a ship should mark the other direction.
-#   Slop count doesn't work properly with partial ships
-
+import argparse
+import functools
+import json
+import multiprocessing
+import random
 import sys
+import time
+from collections import Counter, OrderedDict, namedtuple
+
+import puzzle_batch
 
 ########################################################################
 DEBUG = False
+
+# Worker processes for the search.  1 searches in this process and
+# 0 uses every core.
+PROCESSES = 1
+# The number of ships placed before the search is split into subtrees.
+SPLIT_DEPTH = 2
+# The most sub-problems remembered as having no solution.  0 turns it off.
+DEAD_STATE_TABLE_SIZE = 200000
 WATER = '.'
 U = 99
 
@@ -25,15 +45,22 @@ U = 99
 # KEY FOR USER INPUT
 INPUT_WATER = 'w'
 UNKNOWN = '-'
-SHIP = 's'
 UNKNOWN_COUNT = U
+# Ship hints
+SHIP = 's'         # some part of a ship
+SUBMARINE = 'o'    # a whole ship of length 1
+MIDDLE = 'm'       # neither end of a ship
+LEFT_END = '<'
+RIGHT_END = '>'
+TOP_END = '^'
+BOTTOM_END = 'v'
+HINTS = (SHIP, SUBMARINE, MIDDLE, LEFT_END, RIGHT_END, TOP_END, BOTTOM_END)
 
 # User input goes here
 INIT_ROW_COUNTS = [4, 2, 3, 3, U, U, 3, 3]
 INIT_COL_COUNTS = [4, 3, 1, 2, 2, 1, 3, 4]
 INIT_SHIPS = [4, 3, 3, 2, 2, 2, 1, 1, 1, 1]
 
-# partial ships are not supported yet
 INIT_GRID = [
   "--w--w--",
   "--------",
@@ -47,20 +74,194 @@ INIT_GRID = [
 
 ########################################################################
 
+# int.bit_count is Python 3.10+.
+_PopCount = (getattr(int, "bit_count", None)
+             or (lambda mask: bin(mask).count('1')))
+
+# One way to put a ship on the board, built once by the Board.  The halo is
+# the surrounding water.  The changes are the (line, count) decrements the
+# ship makes and the slops are how much of them fall on unknown count lines.
+# zobrist is the XOR of the Board's cell keys over the ship's cells.
+Placement = namedtuple("Placement", [
+    "ship", "row", "col", "is_vertical", "key", "mask", "halo",
+    "row_changes", "col_changes", "row_slop", "col_slop", "zobrist"])
+
+class Board:
+  """The fixed parts of a puzzle, shared by every State.
+
+     Grids are stored as integer bitmasks.  Cell (row, col) is bit
+     row*ncols + col, so each row is a contiguous run of ncols bits.
+
+     hints maps (row, col) to the hint symbol given there and preplaced is
+     the mask of those cells.
+
+     placements maps each ship length to every Placement of that length
+     that avoids the input water and fits the hints, in key order.
+
+     cell_keys holds a random 64-bit key per cell for Zobrist hashing the
+     ship cells of a State.  They come from a fixed seed, so hashes agree
+     between processes."""
+
+  def __init__(self, row_counts, col_counts, ships, input_water, hints):
+    self.nrows = len(row_counts)
+    self.ncols = len(col_counts)
+    self.row_counts = tuple(row_counts)
+    self.col_counts = tuple(col_counts)
+    self.input_water = input_water
+    self.hints = dict(hints)
+    self.preplaced = 0
+    for (r, c) in self.hints:
+      self.preplaced |= self.Bit(r, c)
+    self.full_mask = (1 << (self.nrows*self.ncols)) - 1
+    self.row_masks = [((1 << self.ncols) - 1) << (r*self.ncols)
+                      for r in range(self.nrows)]
+    self.col_masks = [sum(1 << (r*self.ncols + c) for r in range(self.nrows))
+                      for c in range(self.ncols)]
+    rng = random.Random(0)
+    self.cell_keys = [rng.getrandbits(64)
+                      for _ in range(self.nrows*self.ncols)]
+    self.placements = {ship: self._BuildPlacements(ship) for ship in ships}
+
+  def Bit(self, row, col):
+    return 1 << (row*self.ncols + col)
+
+  def HorizontalMask(self, row, col, size):
+    return ((1 << size) - 1) << (row*self.ncols + col)
+
+  def VerticalMask(self, row, col, size):
+    return sum(1 << ((row+i)*self.ncols + col) for i in range(size))
+
+  def DiagonalNeighbours(self, mask):
+    not_first_col = self.full_mask & ~self.col_masks[0]
+    not_last_col = self.full_mask & ~self.col_masks[-1]
+    ncols = self.ncols
+    neighbours = (((mask & not_last_col) << (ncols+1))
+                  | ((mask & not_first_col) << (ncols-1))
+                  | ((mask & not_first_col) >> (ncols+1))
+                  | ((mask & not_last_col) >> (ncols-1)))
+    return neighbours & self.full_mask
+
+  def RangeMask(self, min_row, min_col, max_row, max_col):
+    """Mask of the inclusive rectangle, clipped to the board."""
+    min_row = max(min_row, 0)
+    min_col = max(min_col, 0)
+    max_row = min(max_row+1, self.nrows)
+    max_col = min(max_col+1, self.ncols)
+    if min_col >= max_col:
+      return 0
+    row_bits = ((1 << (max_col - min_col)) - 1) << min_col
+    mask = 0
+    for r in range(min_row, max_row):
+      mask |= row_bits << (r*self.ncols)
+    return mask
+
+  def _BuildPlacements(self, ship):
+    placements = []
+    for row in range(self.nrows):
+      for col in range(self.ncols):
+        if col + ship <= self.ncols:
+          placements.append(self._Placement(ship, row, col, False))
+        # A vertical submarine is the same as a horizontal one.
+        if ship > 1 and row + ship <= self.nrows:
+          placements.append(self._Placement(ship, row, col, True))
+    return [p for p in placements
+            if not p.mask & self.input_water and self._FitsHints(p)]
+
+  def _FitsHints(self, placement):
+    """A placement must match every hint it covers and can't touch any
+       other hint, since that cell belongs to another ship."""
+    if placement.halo & self.preplaced:
+      return False
+    for i in range(placement.ship):
+      if placement.is_vertical:
+        hint = self.hints.get((placement.row+i, placement.col))
+      else:
+        hint = self.hints.get((placement.row, placement.col+i))
+      if hint and not _HintFits(hint, placement.ship, i,
+                                placement.is_vertical):
+        return False
+    return True
+
+  def HintWaterAndShips(self):
+    """The (water, ship) masks the hints imply: a submarine is surrounded
+       by water, and an end has water behind and beside it and more ship in
+       front of it."""
+    water = 0
+    ships = self.preplaced
+    # hint: (behind, in front)
+    directions = {LEFT_END: ((0, -1), (0, 1)), RIGHT_END: ((0, 1), (0, -1)),
+                  TOP_END: ((-1, 0), (1, 0)), BOTTOM_END: ((1, 0), (-1, 0))}
+    for (r, c), hint in self.hints.items():
+      if hint == SUBMARINE:
+        water |= self.RangeMask(r-1, c-1, r+1, c+1) & ~self.Bit(r, c)
+      elif hint in directions:
+        (br, bc), (fr, fc) = directions[hint]
+        # Beside is the behind direction turned 90 degrees.
+        for dr, dc in ((br, bc), (bc, br), (-bc, -br)):
+          water |= self.RangeMask(r+dr, c+dc, r+dr, c+dc)
+        ships |= self.RangeMask(r+fr, c+fc, r+fr, c+fc)
+    return water, ships
+
+  def _Placement(self, ship, row, col, is_vertical):
+    if is_vertical:
+      mask = self.VerticalMask(row, col, ship)
+      halo = self.RangeMask(row-1, col-1, row+ship, col+1)
+      row_changes = tuple((row+i, 1) for i in range(ship))
+      col_changes = ((col, ship),)
+    else:
+      mask = self.HorizontalMask(row, col, ship)
+      halo = self.RangeMask(row-1, col-1, row+1, col+ship)
+      row_changes = ((row, ship),)
+      col_changes = tuple((col+i, 1) for i in range(ship))
+
+    zobrist = 0
+    for i in range(ship):
+      if is_vertical:
+        zobrist ^= self.cell_keys[(row+i)*self.ncols + col]
+      else:
+        zobrist ^= self.cell_keys[row*self.ncols + col+i]
+
+    return Placement(
+        ship=ship, row=row, col=col, is_vertical=is_vertical,
+        key=_PlacementKey(row, col, self.ncols, is_vertical),
+        mask=mask, halo=halo & ~mask,
+        row_changes=row_changes, col_changes=col_changes,
+        row_slop=sum(n for r, n in row_changes
+                     if UNKNOWN_COUNT == self.row_counts[r]),
+        col_slop=sum(n for c, n in col_changes
+                     if UNKNOWN_COUNT == self.col_counts[c]),
+        zobrist=zobrist)
+
+
 class State:
   """A battleship puzzle.  The class owns and manipulates the state of
-     the puzzle.  The algorithm for what to alter is external to the state."""
+     the puzzle.  The algorithm for what to alter is external to the state.
+
+     Ship and water cells are bitmasks over the Board; any other cell is
+     unknown.  Input water starts in the water mask.  Required cells are
+     unknown cells that Propagate() has shown must be covered by a ship.
+
+     Ships are placed in place.  Each placement pushes an entry on the
+     undo trail and Undo() pops it, restoring the state exactly.
+
+     The hash is the Zobrist hash of the ship cells, kept up to date as
+     ships are placed and taken back.  A solved grid is all ship or water,
+     so its ships are enough to tell it apart."""
 
-  def __init__(self, ships, grid, row_counts, col_counts, row_slop, col_slop,
-               ships_to_cover):
+  def __init__(self, board, ships, ship_mask, water_mask, required_mask,
+               row_counts, col_counts, row_slop, col_slop, placements,
+               last_keys, zobrist=0):
 
     # public
-    self.nrows = len(row_counts)
-    self.ncols = len(col_counts)
+    self.board = board
+    self.nrows = board.nrows
+    self.ncols = board.ncols
 
     # private
-    self._unplaced_ships = ships
-    self._grid = grid
+    self._unplaced_ships = ships  # {ship: count}
+    self._ship_mask = ship_mask
+    self._water_mask = water_mask
+    self._required_mask = required_mask
 
     self._row_counts = row_counts
     self._col_counts = col_counts
@@ -69,29 +270,47 @@ class State:
     # in the initial grid enumeration.
     self._row_count_slop = row_slop
     self._col_count_slop = col_slop
-    self._ships_to_cover = ships_to_cover
+
+    # The Placement of each placed ship, used for printing.
+    self._placements = placements
+
+    # {ship: key of the most recently placed ship of that length}
+    self._last_keys = last_keys
+
+    # XOR of the board's cell keys over the ship mask.
+    self._zobrist = zobrist
+
+    # One entry per placed ship:
+    #   (placement, ship_mask, water_mask, required_mask, row_slop,
+    #    col_slop, last_key)
+    # holding the values from before the placement.
+    self._trail = []
 
   def DeepCopy(self):
-    copy = State(ships=list(self._unplaced_ships),
-                 grid=self._DeepCopyOfGrid(),
+    """A snapshot of the state without its undo trail."""
+    # The masks are immutable ints, so only the small lists need copying.
+    copy = State(board=self.board,
+                 ships=dict(self._unplaced_ships),
+                 ship_mask=self._ship_mask,
+                 water_mask=self._water_mask,
+                 required_mask=self._required_mask,
                  row_counts=list(self._row_counts),
                  col_counts=list(self._col_counts),
                  row_slop=self._row_count_slop,
                  col_slop=self._col_count_slop,
-                 ships_to_cover =self._ships_to_cover)
+                 placements=list(self._placements),
+                 last_keys=dict(self._last_keys),
+                 zobrist=self._zobrist)
     return copy
 
-  def _DeepCopyOfGrid(self):
-    new_grid = list()
-    for row in self._grid:
-      new_grid.append(list(row))
-    return new_grid
-
-  def PrintSolvedGrid(self):
-    print("SOLUTION:", len(solved_states))
-    self._PrintGrid(INIT_ROW_COUNTS, INIT_COL_COUNTS)
+  def PrintSolvedGrid(self, number):
+    print("SOLUTION:", number)
+    self._PrintGrid(self.board.row_counts, self.board.col_counts)
     print("")
 
+  def GridRows(self):
+    return ["".join(row) for row in self._GridOverlaidWithInputWaterAndShips()]
+
   def PrintGrid(self):
     self._PrintGrid(self._row_counts, self._col_counts)
     print("row_slop({}), col_slop({})\n"
@@ -104,13 +323,31 @@ class State:
     col_labels = ",".join([str(col) for col in col_counts])
     print(" ", col_labels.replace(str(U), ' ').replace(',', ''))
 
+  def _Grid(self):
+    """Build the character grid from the masks and placed ships."""
+    grid = [[UNKNOWN] * self.ncols for r in range(self.nrows)]
+    water = self._water_mask
+    while water:
+      r, c = divmod((water & -water).bit_length() - 1, self.ncols)
+      grid[r][c] = WATER
+      water &= water - 1
+    for p in self._placements:
+      for i in range(p.ship):
+        if p.is_vertical:
+          grid[p.row+i][p.col] = str(p.ship)
+        else:
+          grid[p.row][p.col+i] = str(p.ship)
+    return grid
+
   def _GridOverlaidWithInputWaterAndShips(self):
     """Put back the water and ship symbols provided in the initial input"""
-    grid = self._DeepCopyOfGrid()
+    grid = self._Grid()
     for r in range(self.nrows):
       for c in range(self.ncols):
-        if INIT_GRID[r][c] == INPUT_WATER or INIT_GRID[r][c] == SHIP:
-          grid[r][c] = INIT_GRID[r][c]
+        if self.board.Bit(r, c) & self.board.input_water:
+          grid[r][c] = INPUT_WATER
+        elif (r, c) in self.board.hints:
+          grid[r][c] = self.board.hints[(r, c)]
     return grid
 
   def FillWater(self):
@@ -123,107 +360,167 @@ class State:
       if not self._col_counts[col]:
         self._FillColumnWithWater(col)
 
-  def NextUnplacedShip(self):
-    return self._unplaced_ships[0]
+    if not self._row_count_slop:
+      self._FillUnknownRowsWithWater()
+    if not self._col_count_slop:
+      self._FillUnknownColumnsWithWater()
+
+  def Propagate(self):
+    """Deduce forced water and ship cells until nothing more changes.
+       Returns False if a row or column can no longer be filled."""
+    while True:
+      water_mask = self._water_mask
+      required_mask = self._required_mask
+      if not (self._PropagateLines(self.board.row_masks, self._row_counts,
+                                   self._row_count_slop)
+              and self._PropagateLines(self.board.col_masks,
+                                       self._col_counts,
+                                       self._col_count_slop)):
+        return False
+
+      # Ships never touch diagonally, even their own cells.
+      self._water_mask |= (self.board.DiagonalNeighbours(self._required_mask)
+                           & ~self._ship_mask)
+      if self._water_mask & self._required_mask:
+        return False
+
+      if (water_mask == self._water_mask
+          and required_mask == self._required_mask):
+        return True
+
+  def _PropagateLines(self, line_masks, counts, slop):
+    """A line needs at least its remaining count of open cells, and when it
+       has exactly that many they must all be ship.  The unknown count
+       lines are treated the same way as one line holding the slop."""
+    all_open = self.board.full_mask & ~(self._water_mask | self._ship_mask)
+    unknown_open = 0
+    for line_mask, count in zip(line_masks, counts):
+      open_cells = line_mask & all_open
+      if UNKNOWN_COUNT == count:
+        unknown_open |= open_cells
+      elif count and not self._CheckOpenCells(open_cells, count):
+        return False
+    return self._CheckOpenCells(unknown_open, slop)
+
+  def _CheckOpenCells(self, open_cells, count):
+    n_open = _PopCount(open_cells)
+    if n_open < count:
+      return False
+    if n_open == count:
+      self._required_mask |= open_cells
+    elif _PopCount(open_cells & self._required_mask) > count:
+      return False
+    return True
 
   def AllShipsPlaced(self):
     return not self._unplaced_ships
 
-  def NextLegalHorizontalPlacementInRow(self, row, ship, col_offset):
-    if not self._RowHasSpaceForShip(row, ship):
-      return None
-
-    col = col_offset
-    while col+ship <= self.ncols:
-      s = 0
-      while s < ship and self._SpaceCanBeShip(row, col+s):
-        s += 1
-      if s == ship:
-        if (self._SpaceNotShip(row, col+ship)
-            and (self._col_count_slop >=
-                 _Count(UNKNOWN_COUNT, self._col_counts[col:col+ship]))):
-#                 - _Count(SHIP, self._grid[row][col:col+ship]))):
-# Need to check adjacency for preplaced ships
-          return col
-        col += 1   # Optimization likely costs more than brute force
-      else:
-        col += s+1
-
-    return None
-
-
-  def NextLegalVerticalPlacementInColumn(self, col, ship, row_offset):
-    if not self._ColumnHasSpaceForShip(col, ship):
-      return None
-
-    row = row_offset
-    while row+ship <= self.nrows:
-      s = 0
-      while s < ship and self._SpaceCanBeShip(row+s, col):
-        s += 1
-      if s == ship:
-        if (self._SpaceNotShip(row+s, col)
-            and (self._row_count_slop >=
-                 _Count(UNKNOWN_COUNT, self._row_counts[row:row+ship]))):
-#                 - _Count(SHIP, self._grid[row:row+ship][col]))):
-          return row
-        row += 1   # Optimization likely costs more than brute force
-      else:
-        row += s+1
-
-    return None
-
-  def _SpaceCanBeShip(self, row, col):
-    return self._grid[row][col] == UNKNOWN or self._grid[row][col] == SHIP
-
-  def _SpaceNotShip(self, row, col):
-    return (row == self.nrows or col == self.ncols
-            or not self._grid[row][col] == SHIP)
-
-
-  def InsertFirstShipHorizontalAt(self, row, col):
-    new_state = self.DeepCopy()
-    ship = new_state._RemoveFirstUnplacedShip()
-    new_state._MarkHorizontalRangeAsWater(row, col, ship)
-    new_state._DecrementRowCount(row, ship)
-    for i in range(ship):
-      new_state._grid[row][col+i] = str(ship)
-      new_state._DecrementColumCount(col+i)
-
-    if DEBUG:
-      print("Horizontal: size({}) at  ({},{})".format(ship, row, col))
-      new_state.PrintGrid()
-    return new_state
-
-  def InsertFirstShipVerticalAt(self, row, col):
-    new_state = self.DeepCopy()
-    ship = new_state._RemoveFirstUnplacedShip()
-    new_state._MarkVerticalRangeAsWater(row, col, ship)
-    new_state._DecrementColumCount(col, ship)
-    for i in range(ship):
-      new_state._grid[row+i][col] = str(ship)
-      new_state._DecrementRowCount(row+i)
+  def ShipsPlaced(self):
+    return len(self._placements)
+
+  def PlacedShips(self):
+    """The Placements made so far, which is all that defines a solution."""
+    return tuple(self._placements)
+
+  def LegalPlacements(self, candidates, rejected=None):
+    """Filter each unplaced ship's candidate placements down to the legal
+       ones.  The candidates are the Board's placements or a parent node's
+       legal placements, since nothing becomes legal again further down.
+
+       Each rule is a separate pass, so when rejected is a Counter the
+       placements each rule drops are counted by rule name.
+
+       Returns {ship: [Placement]}, or None if some ship length has fewer
+       legal placements than ships of that length left to place."""
+    blocked = self._water_mask | self._ship_mask
+    required = self._required_mask
+    row_counts = self._row_counts
+    col_counts = self._col_counts
+    row_slop = self._row_count_slop
+    col_slop = self._col_count_slop
+
+    legal = {}
+    for ship, count in self._unplaced_ships.items():
+      # Ships of the same length are interchangeable, so each one must be
+      # placed after the previous one of that length.
+      min_key = self._last_keys.get(ship, -1)
+      placements = candidates[ship]
+      n = len(placements)
+      placements = [p for p in placements if p.key > min_key]
+      if rejected is not None:
+        rejected["order"] += n - len(placements)
+        n = len(placements)
+      placements = [p for p in placements if not p.mask & blocked]
+      if rejected is not None:
+        rejected["occupied"] += n - len(placements)
+        n = len(placements)
+      placements = [p for p in placements if not p.halo & required]
+      if rejected is not None:
+        rejected["adjacent"] += n - len(placements)
+        n = len(placements)
+      placements = [p for p in placements
+                    if p.row_slop <= row_slop and p.col_slop <= col_slop]
+      if rejected is not None:
+        rejected["slop"] += n - len(placements)
+        n = len(placements)
+      # Unknown counts are U, so they always pass the count check and are
+      # limited by the slop instead.
+      placements = [p for p in placements
+                    if (col_counts[p.col] if p.is_vertical
+                        else row_counts[p.row]) >= ship]
+      if rejected is not None:
+        rejected["line space"] += n - len(placements)
+      if len(placements) < count:
+        return None
+      legal[ship] = placements
+    return legal
+
+  def PlaceShip(self, placement):
+    """Place a ship in place, Undo() takes it back out."""
+    p = placement
+    self._trail.append((p, self._ship_mask, self._water_mask,
+                        self._required_mask, self._row_count_slop,
+                        self._col_count_slop, self._last_keys.get(p.ship)))
+    self._RemoveUnplacedShip(p.ship)
+    self._last_keys[p.ship] = p.key
+    self._water_mask |= p.halo
+    self._MarkShip(p)
+    for row, count in p.row_changes:
+      self._DecrementRowCount(row, count)
+    for col, count in p.col_changes:
+      self._DecrementColumCount(col, count)
 
     if DEBUG:
-      print("Vertical: size({}) at  ({},{})".format(ship, row, col))
-      new_state.PrintGrid()
-
-    return new_state
-
-  def _RowHasSpaceForShip(self, row, ship):
-    if UNKNOWN_COUNT == self._row_counts[row]:
-      return ship <= self._row_count_slop
-    return ship <= self._row_counts[row]
-
-  def _ColumnHasSpaceForShip(self, col, ship):
-    if UNKNOWN_COUNT == self._col_counts[col]:
-      return ship <= self._col_count_slop
-    return ship <= self._col_counts[col]
+      print("{}: size({}) at  ({},{})"
+            .format("Vertical" if p.is_vertical else "Horizontal",
+                    p.ship, p.row, p.col))
+      self.PrintGrid()
+
+  def Undo(self):
+    """Take back the most recently placed ship."""
+    (p, self._ship_mask, self._water_mask, self._required_mask,
+     self._row_count_slop, self._col_count_slop,
+     last_key) = self._trail.pop()
+    for row, count in p.row_changes:
+      if UNKNOWN_COUNT != self._row_counts[row]:
+        self._row_counts[row] += count
+    for col, count in p.col_changes:
+      if UNKNOWN_COUNT != self._col_counts[col]:
+        self._col_counts[col] += count
+    self._placements.pop()
+    self._unplaced_ships[p.ship] = self._unplaced_ships.get(p.ship, 0) + 1
+    self._zobrist ^= p.zobrist
+    if last_key is None:
+      del self._last_keys[p.ship]
+    else:
+      self._last_keys[p.ship] = last_key
 
   def _DecrementRowCount(self, row, count=1):
     # TODO: Fix method name.  More than the count is changed
     if UNKNOWN_COUNT == self._row_counts[row]:
       self._row_count_slop -= count
+      if not self._row_count_slop:
+        self._FillUnknownRowsWithWater()
       return
     self._row_counts[row] -= count
     if not self._row_counts[row]:
@@ -233,98 +530,369 @@ class State:
     # TODO: Fix method name.  More than the count is changed
     if UNKNOWN_COUNT == self._col_counts[col]:
       self._col_count_slop -= count
+      if not self._col_count_slop:
+        self._FillUnknownColumnsWithWater()
       return
     self._col_counts[col] -= count
     if not self._col_counts[col]:
       self._FillColumnWithWater(col)
 
-  def _RemoveFirstUnplacedShip(self):
-    return self._unplaced_ships.pop(0)
+  def _RemoveUnplacedShip(self, ship):
+    self._unplaced_ships[ship] -= 1
+    if not self._unplaced_ships[ship]:
+      del self._unplaced_ships[ship]
 
   def _FillRowWithWater(self, row):
-    for c in range(self.ncols):
-      if self._grid[row][c] == UNKNOWN:
-        self._grid[row][c] = WATER
+    self._MarkUnknownAsWater(self.board.row_masks[row])
 
   def _FillColumnWithWater(self, column):
-    for r in range(self.nrows):
-      if self._grid[r][column] == UNKNOWN:
-        self._grid[r][column] = WATER
+    self._MarkUnknownAsWater(self.board.col_masks[column])
 
-  def _MarkRangeAsWater(self, min_row, min_col, max_row, max_col):
-    """Mark as water says make it water, don't check previous state."""
-    min_row = max(min_row, 0)
-    min_col = max(min_col, 0)
-    max_row = min(max_row+1, self.nrows)
-    max_col = min(max_col+1, self.ncols)
-    for r in range(min_row, max_row):
-      for c in range(min_col, max_col):
-        self._grid[r][c] = WATER
+  def _FillUnknownRowsWithWater(self):
+    for row in range(self.nrows):
+      if UNKNOWN_COUNT == self._row_counts[row]:
+        self._FillRowWithWater(row)
 
-  def _MarkHorizontalRangeAsWater(self, row, col, size):
-    self._MarkRangeAsWater(row-1, col-1, row+1, col+size)
+  def _FillUnknownColumnsWithWater(self):
+    for col in range(self.ncols):
+      if UNKNOWN_COUNT == self._col_counts[col]:
+        self._FillColumnWithWater(col)
 
-  def _MarkVerticalRangeAsWater(self, row, col, size):
-    self._MarkRangeAsWater(row-1, col-1, row+size, col+1,)
+  def _MarkShip(self, placement):
+    self._ship_mask |= placement.mask
+    self._water_mask &= ~placement.mask
+    self._required_mask &= ~placement.mask
+    self._zobrist ^= placement.zobrist
+    self._placements.append(placement)
+
+  def _MarkUnknownAsWater(self, mask):
+    """Ships are left alone.  Hint cells are not, so filling one is a
+       contradiction that Propagate() finds."""
+    self._water_mask |= mask & ~self._ship_mask
+
+  def SubproblemKey(self, legal):
+    """A key for what is left to solve, given this node's legal placements.
+
+       Closed cells are the same to the rest of the search whether they are
+       ship or water.  The canonical order bound for each ship length only
+       matters through the first placement it still allows."""
+    return (self.board.full_mask & ~(self._water_mask | self._ship_mask),
+            self._required_mask,
+            tuple(self._row_counts), tuple(self._col_counts),
+            self._row_count_slop, self._col_count_slop,
+            tuple((ship, self._unplaced_ships[ship],
+                   placements[0].key if placements else None)
+                  for ship, placements in sorted(legal.items())))
 
   def __eq__(self, other):
-    return self.__hash__() == other.__hash__()
+    # The grids are only compared when the hashes match.
+    return (self._zobrist == other._zobrist
+            and (self._ship_mask, self._water_mask)
+                == (other._ship_mask, other._water_mask))
 
   def __hash__(self):
     # Only care about the grid
-    h = ""
-    for r in self._GridOverlaidWithInputWaterAndShips():
-      h += "".join(r)
-    return hash(h)
+    return self._zobrist
+
+
+class DeadStates:
+  """A bounded set of SubproblemKeys known to have no solutions.
+     The least recently used key is dropped when the set is full."""
+
+  def __init__(self, max_size=DEAD_STATE_TABLE_SIZE):
+    self._keys = OrderedDict()
+    self._max_size = max_size
+
+  def __contains__(self, key):
+    if key not in self._keys:
+      return False
+    self._keys.move_to_end(key)
+    return True
+
+  def Add(self, key):
+    self._keys[key] = None
+    if len(self._keys) > self._max_size:
+      self._keys.popitem(last=False)
+
+
+class SearchStats:
+  """Counts what the search does, cheaply enough to leave on.
+
+     Depth is the number of ships placed.  Each depth gets the nodes
+     expanded there and the seconds spent in them, including their
+     subtrees.  rejected counts the candidate placements each rule threw
+     out, with "propagate" for placements that Propagate() then failed.
+
+     With progress_seconds set, a progress line is written to progress_file
+     about that often."""
+
+  # Nodes between looks at the clock for progress lines.
+  PROGRESS_NODES = 1024
+
+  def __init__(self, progress_seconds=0, progress_file=sys.stderr):
+    self.nodes = []
+    self.seconds = []
+    self.tried = 0
+    self.rejected = Counter()
+    self.dead_state_hits = 0
+    self.solutions = 0
+    self._start = time.perf_counter()
+    self._progress_seconds = progress_seconds
+    self._progress_file = progress_file
+    self._next_progress = self._start + progress_seconds
+    self._total_nodes = 0
+
+  def StartNode(self, depth):
+    """Count a node and return its start time for EndNode()."""
+    while len(self.nodes) <= depth:
+      self.nodes.append(0)
+      self.seconds.append(0.0)
+    self.nodes[depth] += 1
+    self._total_nodes += 1
+    now = time.perf_counter()
+    if (self._progress_seconds
+        and not self._total_nodes % self.PROGRESS_NODES
+        and now >= self._next_progress):
+      self._next_progress = now + self._progress_seconds
+      self._PrintProgress(now, depth)
+    return now
+
+  def EndNode(self, depth, start):
+    self.seconds[depth] += time.perf_counter() - start
+
+  def _PrintProgress(self, now, depth):
+    elapsed = now - self._start
+    print("{:.1f}s: {} nodes ({:.0f}/s), depth {}, {} solutions"
+          .format(elapsed, self._total_nodes,
+                  self._total_nodes / elapsed if elapsed else 0,
+                  depth, self.solutions),
+          file=self._progress_file, flush=True)
+
+  def Summary(self):
+    """The stats as a JSON-able dict."""
+    return {"nodes": sum(self.nodes),
+            "solutions": self.solutions,
+            "tried": self.tried,
+            "rejected": dict(self.rejected),
+            "dead_state_hits": self.dead_state_hits,
+            "seconds": round(time.perf_counter() - self._start, 6),
+            "depths": [{"depth": depth, "nodes": nodes,
+                        "seconds": round(seconds, 6)}
+                       for depth, (nodes, seconds)
+                       in enumerate(zip(self.nodes, self.seconds))]}
+
+  def Merge(self, summary):
+    """Add in the counts from another search's Summary()."""
+    for depth in summary["depths"]:
+      while len(self.nodes) <= depth["depth"]:
+        self.nodes.append(0)
+        self.seconds.append(0.0)
+      self.nodes[depth["depth"]] += depth["nodes"]
+      self.seconds[depth["depth"]] += depth["seconds"]
+    self.tried += summary["tried"]
+    self.rejected.update(summary["rejected"])
+    self.dead_state_hits += summary["dead_state_hits"]
+    self.solutions += summary["solutions"]
 
 
 ########################################################################
 # Placement Algorithm (not part of the class)
 
-def _TryInsertFirstShipHorizontal(state):
-  ship = state.NextUnplacedShip()
-  for r in range(state.nrows):
-    c = state.NextLegalHorizontalPlacementInRow(r, ship, col_offset=0)
-    while c is not None:
-      _Solve(state.InsertFirstShipHorizontalAt(r, c))
-      c = state.NextLegalHorizontalPlacementInRow(r, ship, c+1)
-  return False
-
-def _TryInsertFirstShipVertical(state):
-  ship = state.NextUnplacedShip()
-  for c in range(state.ncols):
-    r = state.NextLegalVerticalPlacementInColumn(c, ship, row_offset=0)
-    while r is not None:
-      _Solve(state.InsertFirstShipVerticalAt(r, c))
-      r = state.NextLegalVerticalPlacementInColumn(c, ship, r+1)
-  return False
-
-solved_states = set()
-def _Solve(state):
+# The canonical ship order means every solution is only found once.
+solved_states = []
+def _PrintSolution(state):
+  solved = state.DeepCopy()
+  solved_states.append(solved)
+  solved.PrintSolvedGrid(len(solved_states))
+
+def _NewDeadStates():
+  return DeadStates() if DEAD_STATE_TABLE_SIZE else None
+
+def _Solve(state, candidates, found, max_solutions=0, dead_states=None,
+           stats=None):
+  """Calls found(state) for each solution below state, stopping the search
+     once max_solutions have been found (0 is no limit).
+     Returns the number of solutions found.
+
+     Sub-problems that turn out to have no solutions are added to
+     dead_states, and skipped when they come up again.  stats, a
+     SearchStats, counts the work done."""
+  if stats is None:
+    return _SolveNode(state, candidates, found, max_solutions, dead_states,
+                      stats)
+  depth = state.ShipsPlaced()
+  start = stats.StartNode(depth)
+  nsolutions = _SolveNode(state, candidates, found, max_solutions,
+                          dead_states, stats)
+  stats.EndNode(depth, start)
+  return nsolutions
+
+def _SolveNode(state, candidates, found, max_solutions, dead_states, stats):
   if state.AllShipsPlaced():
-    if state not in solved_states:
-      solved_states.add(state)
-      state.PrintSolvedGrid()
+    if stats is not None:
+      stats.solutions += 1
+    found(state)
+    return 1
+
+  legal = state.LegalPlacements(candidates,
+                                stats.rejected if stats is not None else None)
+  if legal is None:
+    return 0
+
+  if dead_states is not None:
+    key = state.SubproblemKey(legal)
+    if key in dead_states:
+      if stats is not None:
+        stats.dead_state_hits += 1
+      return 0
+
+  # Branch on the ship with the fewest places left to go.
+  ship = min(legal, key=lambda s: len(legal[s]))
+  if DEBUG:
+    print("Placing ship({}), {} ways".format(ship, len(legal[ship])))
+
+  nsolutions = 0
+  for placement in legal[ship]:
+    state.PlaceShip(placement)
+    if state.Propagate():
+      nsolutions += _Solve(state, legal, found,
+                           max_solutions and max_solutions - nsolutions,
+                           dead_states, stats)
+    elif stats is not None:
+      stats.rejected["propagate"] += 1
+    state.Undo()
+    if stats is not None:
+      stats.tried += 1
+    if max_solutions and nsolutions >= max_solutions:
+      break
+
+  # A search that was cut short found something, so this one was complete.
+  if not nsolutions and dead_states is not None:
+    dead_states.Add(key)
+  return nsolutions
+
+
+########################################################################
+# Parallel search: the first SPLIT_DEPTH placements are made here and each
+# resulting subtree is searched by a pool worker.
+
+def _SplitSearch(state, candidates, depth):
+  """Yields the placement paths leading to each subtree at depth."""
+  if not depth or state.AllShipsPlaced():
+    yield ()
     return
 
-  if DEBUG:
-    print("Ships Remaining({}) {}".format(len(state.ships), state.ships))
+  legal = state.LegalPlacements(candidates)
+  if legal is None:
+    return
 
-  _ = _TryInsertFirstShipHorizontal(state) or _TryInsertFirstShipVertical(state)
+  ship = min(legal, key=lambda s: len(legal[s]))
+  for placement in legal[ship]:
+    state.PlaceShip(placement)
+    if state.Propagate():
+      for path in _SplitSearch(state, legal, depth-1):
+        yield (placement,) + path
+    state.Undo()
+
+def _PlacePath(state, path):
+  for placement in path:
+    state.PlaceShip(placement)
+    state.Propagate()
+
+_worker_state = None
+_worker_dead_states = None
+def _InitWorker(state):
+  global _worker_state, _worker_dead_states
+  _worker_state = state
+  _worker_dead_states = _NewDeadStates()
+
+def _SolveSubtree(path, max_solutions, with_stats):
+  """Worker task.  Returns the placements of each solution under path, and
+     the SearchStats summary of the subtree if with_stats is set."""
+  solutions = []
+  stats = SearchStats() if with_stats else None
+  _PlacePath(_worker_state, path)
+  # Filtering the full index gives the same legal placements as the
+  # parent's list would have.
+  _Solve(_worker_state, _worker_state.board.placements,
+         lambda solved: solutions.append(solved.PlacedShips()),
+         max_solutions, _worker_dead_states, stats)
+  for _ in path:
+    _worker_state.Undo()
+  return solutions, stats and stats.Summary()
+
+def _ParallelSolve(state, processes, found, max_solutions=0, stats=None):
+  """Solve with a process pool, calling found(state) for each solution.
+     The pool is stopped once max_solutions have been found (0 is no limit).
+     Returns the number of solutions found.
+
+     The workers' stats are merged into stats, which leaves out the nodes
+     above the split.
+
+     Subtrees are handed out one at a time as workers free up, since their
+     sizes vary wildly."""
+  paths = list(_SplitSearch(state, state.board.placements, SPLIT_DEPTH))
+  task = functools.partial(_SolveSubtree, max_solutions=max_solutions,
+                           with_stats=stats is not None)
+  seen = set()
+  with multiprocessing.Pool(processes or None, initializer=_InitWorker,
+                            initargs=(state,)) as pool:
+    for solutions, summary in pool.imap_unordered(task, paths, chunksize=1):
+      if summary:
+        stats.Merge(summary)
+      for placements in solutions:
+        _PlacePath(state, placements)
+        if state not in seen:
+          seen.add(state.DeepCopy())
+          found(state)
+        for _ in placements:
+          state.Undo()
+        if max_solutions and len(seen) >= max_solutions:
+          return len(seen)  # Leaving the with block stops the workers.
+  return len(seen)
 
 
 ########################################################################
 # Initializaiton
 
-def _SplitInputRowStringsIntoArrays(grid):
-  return [list(row) for row in grid]
+def _GridMask(grid, symbol):
+  """Bitmask of the cells in the input grid matching symbol."""
+  ncols = len(grid[0])
+  mask = 0
+  for r, row in enumerate(grid):
+    for c, cell in enumerate(row):
+      if cell == symbol:
+        mask |= 1 << (r*ncols + c)
+  return mask
+
+def _GridHints(grid):
+  """Maps (row, col) to the hint symbol for each hint in the input grid."""
+  return {(r, c): cell for r, row in enumerate(grid)
+          for c, cell in enumerate(row) if cell in HINTS}
+
+def _HintFits(hint, ship, index, is_vertical):
+  """Whether cell index of a ship can be shown by the hint."""
+  first = index == 0
+  last = index == ship - 1
+  if hint == SUBMARINE:
+    return ship == 1
+  if hint == MIDDLE:
+    return not first and not last
+  if hint in (LEFT_END, RIGHT_END):
+    return (ship > 1 and not is_vertical
+            and (first if hint == LEFT_END else last))
+  if hint in (TOP_END, BOTTOM_END):
+    return (ship > 1 and is_vertical
+            and (first if hint == TOP_END else last))
+  return True
+
+def _PlacementKey(row, col, ncols, is_vertical):
+  """The order in which same length ships are placed."""
+  return 2 * (row*ncols + col) + is_vertical
 
 def _Count(x, iterable):
   return sum([1 for n in iterable if n == x])
 
-def _GetPreplacedShipCount(grid):
-  return sum([row.count(SHIP) for row in grid])
-
 def _GetRowAndColSlopCounts(row_counts, col_counts, ships):
   """The slop is the amount not pre-assigned to a given column or row."""
   ship_sum = sum(ships)
@@ -333,27 +901,137 @@ def _GetRowAndColSlopCounts(row_counts, col_counts, ships):
   row_slop = ship_sum - row_sum
   col_slop = ship_sum - col_sum
   if (row_slop < 0) or (col_slop < 0):
-    sys.exit("Invalid state: ship_sum({}) row_sum({}), col_sum({})"
-             .format(ship_sum, row_sum, col_sum))
+    raise ValueError("Invalid state: ship_sum({}) row_sum({}), col_sum({})"
+                     .format(ship_sum, row_sum, col_sum))
   return row_slop, col_slop
 
+def _CreateStartingState(row_counts, col_counts, ships, grid):
+  """Returns the starting State and whether it passed propagation."""
+  if not row_counts or not col_counts:
+    raise ValueError("Board has no rows or no columns")
+  if any(ship < 1 for ship in ships):
+    raise ValueError("Ship lengths must be at least 1")
+  if (len(grid) != len(row_counts)
+      or any(len(row) != len(col_counts) for row in grid)):
+    raise ValueError("Grid is not {}x{}"
+                     .format(len(row_counts), len(col_counts)))
+  board = Board(row_counts=row_counts, col_counts=col_counts,
+                ships=set(ships),
+                input_water=_GridMask(grid, INPUT_WATER),
+                hints=_GridHints(grid))
+  row_slop, col_slop = _GetRowAndColSlopCounts(row_counts, col_counts, ships)
+  hint_water, hint_ships = board.HintWaterAndShips()
+
+  state = State(board=board, ships=dict(Counter(ships)),
+                ship_mask=0, water_mask=board.input_water | hint_water,
+                required_mask=hint_ships,
+                row_counts=list(row_counts), col_counts=list(col_counts),
+                row_slop=row_slop, col_slop=col_slop, placements=[],
+                last_keys={})
+  state.FillWater()
+  # A hint no placement fits can never be covered.
+  coverable = 0
+  for placements in board.placements.values():
+    for p in placements:
+      coverable |= p.mask
+  if board.preplaced & ~coverable:
+    return state, False
+  return state, state.Propagate()
+
+
+########################################################################
+# Batch mode
+
+def _CountsFromJson(counts):
+  return [UNKNOWN_COUNT if count in ("U", None) else count
+          for count in counts]
+
+def _SolvePuzzleLine(task, max_solutions, count_only, with_stats=False,
+                     progress_seconds=0):
+  """Batch task.  Returns the JSON-able result for one puzzle line."""
+  name, line = task
+  start = time.perf_counter()
+  try:
+    puzzle = json.loads(line)
+    name = puzzle.get("name", name)
+    row_counts = _CountsFromJson(puzzle["rows"])
+    col_counts = _CountsFromJson(puzzle["cols"])
+    grid = puzzle.get("grid") or [UNKNOWN * len(col_counts)] * len(row_counts)
+    state, solvable = _CreateStartingState(row_counts, col_counts,
+                                           puzzle["ships"], grid)
+  except puzzle_batch.PUZZLE_ERRORS as e:
+    return puzzle_batch.ErrorResult(name, e)
+
+  solutions = []
+  if count_only:
+    found = lambda solved: None
+  else:
+    found = lambda solved: solutions.append(solved.GridRows())
+  stats = None
+  if with_stats or progress_seconds:
+    stats = SearchStats(progress_seconds)
+  count = 0
+  if solvable:
+    count = _Solve(state, state.board.placements, found, max_solutions,
+                   _NewDeadStates(), stats)
+  result = {"name": name, "count": count}
+  if max_solutions:
+    result["capped"] = count >= max_solutions
+  if not count_only:
+    result["solutions"] = solutions
+  result["seconds"] = round(time.perf_counter() - start, 6)
+  if with_stats:
+    result["stats"] = stats.Summary()
+  return result
+
 ########################################################################
+def _ParseCommandLineArguments(argv):
+  parser = argparse.ArgumentParser(
+      formatter_class=argparse.RawTextHelpFormatter,
+      description=__doc__)
+
+  puzzle_batch.AddArguments(parser)
+
+  parser.add_argument("--processes", "-p", type=int, default=PROCESSES,
+      help="Worker processes; 1 runs in this process, 0 uses every core."
+           "\nDefault: %d" % PROCESSES)
+
+  parser.add_argument("--stats", "-s", action="store_true",
+      help="Print the search stats as a JSON line at the end."
+           "\nIn batch mode each result gets a \"stats\" entry.")
+
+  parser.add_argument("--progress", type=float, default=0,
+      help="Print a progress line to stderr about every this many seconds."
+           "\nA single puzzle needs --processes 1 for them."
+           "\nDefault: no progress lines")
+
+  args = parser.parse_args(argv[1:])
+  if args.progress and args.processes != 1 and not args.puzzles:
+    parser.error("--progress only works with --processes 1")
+  puzzle_batch.ApplyLimits(args)
+
+  return args
+
 def main():
   """Solves battleship puzzle, printing all solutions as they are found.
-     The initial puzzle specification must be entered at the top of this file.
-     This implementaiton does not handle partial ships.
+     The initial puzzle specification must be entered at the top of this file,
+     unless a puzzle file is given.
   """
-  grid = _SplitInputRowStringsIntoArrays(INIT_GRID)
-  preplaced_ship_count = _GetPreplacedShipCount(INIT_GRID)
-  row_slop, col_slop = _GetRowAndColSlopCounts(INIT_ROW_COUNTS,
-                                               INIT_COL_COUNTS, INIT_SHIPS)
-
-  state = State(ships=INIT_SHIPS,
-                grid=grid,
-                row_counts=INIT_ROW_COUNTS, col_counts=INIT_COL_COUNTS,
-                row_slop=row_slop, col_slop=col_slop,
-                ships_to_cover=preplaced_ship_count)
-  state.FillWater()
+  args = _ParseCommandLineArguments(sys.argv)
+  if args.puzzles:
+    solve = functools.partial(
+        _SolvePuzzleLine, max_solutions=args.max_solutions,
+        count_only=args.count_only, with_stats=args.stats,
+        progress_seconds=args.progress)
+    with puzzle_batch.OpenOutput(args.output) as output:
+      puzzle_batch.SolveBatch(args.puzzles, args.processes, output, solve)
+    return
+
+  try:
+    state, solvable = _CreateStartingState(INIT_ROW_COUNTS, INIT_COL_COUNTS,
+                                           INIT_SHIPS, INIT_GRID)
+  except ValueError as e:
+    sys.exit(e)
   print("Starting state after filling in any initial water.")
   print("{}x{} with {} ships, needing a total of {} spaces."
         .format(state.nrows, state.ncols, len(INIT_SHIPS), sum(INIT_SHIPS)))
@@ -361,8 +1039,30 @@ def main():
   state.PrintGrid()
 
   # Solutions are printed as they are found.
-  _Solve(state)
-  print("No (more) solutions.")
+  found = (lambda solved: None) if args.count_only else _PrintSolution
+  stats = None
+  if args.stats or args.progress:
+    stats = SearchStats(args.progress)
+  if not solvable:
+    count = 0
+  elif args.processes == 1:
+    count = _Solve(state, state.board.placements, found, args.max_solutions,
+                   _NewDeadStates(), stats)
+  else:
+    count = _ParallelSolve(state, args.processes, found, args.max_solutions,
+                           stats)
+
+  if args.unique:
+    print("Solutions:", ["none", "unique", "multiple"][count])
+  elif args.max_solutions and count >= args.max_solutions:
+    print("Stopped after {} solutions.".format(count))
+  elif args.count_only:
+    print("Solutions:", count)
+  else:
+    print("No (more) solutions.")
+
+  if args.stats:
+    print(json.dumps(stats.Summary()))
 
 if __name__ == '__main__':
   main()
@@ -1,14 +1,47 @@
 #!/usr/bin/python3
 """Jigsaw puzzle solver"
 The program will run to find all possible solutions, printing each as found.
-Modify this file to specify the pieces and whether the pieces can be rotated.
+Modify this file to specify the pieces and whether the pieces can be rotated
+or reflected.
+
+To solve many puzzles, pass a puzzle file or a directory of them.  Each line
+of a puzzle file is a JSON puzzle, e.g.
+  {"name": "sample", "rows": 4, "cols": 5,
+   "grid": ["     ", "     ", "  x  ", "     "],
+   "pieces": [["11", "11"], [" 2", "2 ", "2 "], ["333"], ...],
+   "rotate": true, "reflect": false}
+"name", "grid", "rotate" (default true) and "reflect" (default false) are
+optional.  One JSON line per puzzle is written with its solutions, its
+tiling counts and the seconds taken, as each puzzle finishes.
+
+Other programs can use Solutions(), which yields the solutions one at a
+time, or CountSolutions().
 """
 
+import argparse
+import functools
+import json
+import math
+import multiprocessing
+import random
 import sys
+import time
+from collections import Counter, namedtuple
 from pprint import PrettyPrinter
 
+import puzzle_batch
+
 DEBUG = False
 
+# Worker processes for the search.  1 searches in this process and
+# 0 uses every core.
+PROCESSES = 1
+# The number of pieces placed before the search is split into subtrees.
+SPLIT_DEPTH = 2
+# The most pieces and piece sets whose orientations are remembered for later
+# puzzles.  The least recently used are dropped first.
+SHAPE_CACHE_SIZE = 4096
+
 ########################################################################
 # User input goes here
 
@@ -24,6 +57,7 @@ COL_COUNT = 5
 #           Enter each piece as a rectangle with blanks as needed
 #           The piece should touch every edge (no blank edge columns or rows)
 ALLOW_ROTATED_PIECES = True
+ALLOW_REFLECTED_PIECES = False
 PIECES = [
 ]
 
@@ -60,173 +94,836 @@ if USE_SAMPLE_DATA:
   ROW_COUNT = 4
   COL_COUNT = 5
 
+# int.bit_count is Python 3.10+.
+_PopCount = (getattr(int, "bit_count", None)
+             or (lambda mask: bin(mask).count('1')))
+
+########################################################################
+# Orientations are worked out once, before the search.
+
+# One way to lay down a piece.  rows are the rows of the piece, cells are
+# the (row, col, char) of each filled cell relative to the top left corner
+# and anchor is the number of leading spaces in the first row, which is the
+# column of the cell that covers the space being filled.
+Orientation = namedtuple("Orientation", ["rows", "cells", "anchor"])
+
+@functools.lru_cache(maxsize=SHAPE_CACHE_SIZE)
+def _Orientations(piece, allow_rotation, allow_reflection):
+  """The distinct orientations of the piece, a tuple of rows, starting with
+     the piece as given.  Orientations matching an earlier one are dropped,
+     so a 2x2 square has just one.  They are kept for later puzzles
+     with the same piece, up to SHAPE_CACHE_SIZE pieces."""
+  shapes = [tuple(piece)]
+  if allow_reflection:
+    shapes.append(_Reflect(shapes[0]))
+  if allow_rotation:
+    shapes = [rotated for shape in shapes
+              for rotated in (shape, _Rotate90(shape), _Rotate180(shape),
+                              _Rotate270(shape))]
+  distinct = []
+  for shape in shapes:
+    if shape not in distinct:
+      distinct.append(shape)
+  return tuple(_Orientation(shape) for shape in distinct)
+
+def _Orientation(rows):
+  cells = tuple((r, c, char) for r, row in enumerate(rows)
+                for c, char in enumerate(row) if not char.isspace())
+  return Orientation(rows=rows, cells=cells,
+                     anchor=_NumberOfLeadingSpacesInFirstRow(rows))
+
+def _NumberOfLeadingSpacesInFirstRow(piece):
+  return len(piece[0]) - len(piece[0].lstrip())
+
+def _Rotate90(piece):
+  """Clockwise."""
+  nrows = len(piece)
+  return tuple("".join(piece[nrows-r-1][c] for r in range(nrows))
+               for c in range(len(piece[0])))
+
+def _Rotate180(piece):
+  return tuple("".join(reversed(row)) for row in reversed(piece))
+
+def _Rotate270(piece):
+  ncols = len(piece[0])
+  return tuple("".join(row[ncols-c-1] for row in piece)
+               for c in range(ncols))
+
+def _Reflect(piece):
+  """Mirror left to right."""
+  return tuple("".join(reversed(row)) for row in piece)
+
+# Pieces of the same shape are placed as one class, so each tiling is found
+# once instead of once for each way to permute the identical pieces.  labels
+# are the characters the pieces of the class are drawn with, handed out to
+# the placed shapes in order.  A piece drawn with more than one character
+# is a class of its own with a label of None, and keeps its characters.
+ShapeClass = namedtuple("ShapeClass", ["orientations", "labels"])
+
+def _ShapeClasses(pieces, allow_rotation, allow_reflection):
+  return _CachedShapeClasses(tuple(tuple(piece) for piece in pieces),
+                             allow_rotation, allow_reflection)
+
+@functools.lru_cache(maxsize=SHAPE_CACHE_SIZE)
+def _CachedShapeClasses(pieces, allow_rotation, allow_reflection):
+  classes = []
+  class_numbers = {}
+  for piece in pieces:
+    orientations = _Orientations(piece, allow_rotation, allow_reflection)
+    chars = set(c for row in piece for c in row if not c.isspace())
+    if len(chars) != 1:
+      classes.append(ShapeClass(orientations=orientations, labels=(None,)))
+      continue
+    shape = frozenset(tuple((r, c) for r, c, char in orientation.cells)
+                      for orientation in orientations)
+    if shape in class_numbers:
+      number = class_numbers[shape]
+      classes[number] = classes[number]._replace(
+          labels=classes[number].labels + tuple(chars))
+    else:
+      class_numbers[shape] = len(classes)
+      classes.append(ShapeClass(orientations=orientations,
+                                labels=tuple(chars)))
+  return tuple(classes)
+
+def _Joined(cells, steps):
+  """The cells reachable from the top left one by the (row, col) steps."""
+  cells = set(cells)
+  joined = set([min(cells)])
+  todo = list(joined)
+  while todo:
+    r, c = todo.pop()
+    for row_step, col_step in steps:
+      cell = (r+row_step, c+col_step)
+      if cell in cells and cell not in joined:
+        joined.add(cell)
+        todo.append(cell)
+  return joined
+
+def _LabelledTilingsPerTiling(classes):
+  """The ways to hand out each class's labels to its placed shapes, with
+     pieces drawn the same way not told apart."""
+  count = 1
+  for shape_class in classes:
+    count *= math.factorial(len(shape_class.labels))
+    for same in Counter(shape_class.labels).values():
+      count //= math.factorial(same)
+  return count
+
+def _InLabelOrder(placed):
+  """The placed shapes in the order labels are handed out: by the first
+     space each covers.  It doesn't depend on the order the search placed
+     them in, so every search draws a tiling the same way."""
+  return sorted(placed, key=lambda p: (p[2] + p[1].cells[0][0],
+                                       p[3] + p[1].cells[0][1]))
+
+def _SolvedGrid(grid, classes, placed):
+  """The character grid with each (class number, orientation, row, col)
+     placed drawn in, row and col being the top left corner."""
+  solved_grid = [list(row) for row in grid]
+  next_label = [0] * len(classes)
+  for class_number, orientation, row, col in _InLabelOrder(placed):
+    label = classes[class_number].labels[next_label[class_number]]
+    next_label[class_number] += 1
+    for row_delta, col_delta, c in orientation.cells:
+      solved_grid[row+row_delta][col+col_delta] = label or c
+  return solved_grid
+
+def _SharesDrawChars(classes):
+  """True if some char can be drawn by more than one piece.  Only then can
+     two different tilings draw the same grid."""
+  uses = Counter()
+  for shape_class in classes:
+    for label in shape_class.labels:
+      if label:
+        uses[label] += 1
+      else:
+        uses.update(set(c for orientation in shape_class.orientations
+                        for row_delta, col_delta, c in orientation.cells))
+  return any(n > 1 for n in uses.values())
+
+class GridHash:
+  """Zobrist hashes of solved grids, to spot a repeated grid without
+     drawing it.  Blocked spaces are the same in every solution and are
+     left out.
+
+     The label a shape is drawn with depends on the other shapes placed, so
+     the keys are for a space and a draw group rather than a char, the
+     chars any one class can be drawn with being in the same group.  Then
+     a placement's key doesn't depend on the rest of the tiling and the
+     State can keep the hash up to date as pieces are placed and removed.
+     Equal grids hash the same, but so can some different ones.
+
+     Every key is made up front from a fixed seed, so worker processes and
+     later runs agree."""
+
+  def __init__(self, classes, nrows, ncols):
+    self._classes = classes
+    self._ncols = ncols
+    # Union-find over the draw chars, joining each class's labels.
+    parent = {}
+    def _Find(c):
+      while parent.setdefault(c, c) != c:
+        c = parent[c]
+      return c
+    for shape_class in classes:
+      for orientation in shape_class.orientations:
+        for row_delta, col_delta, c in orientation.cells:
+          _Find(c)
+      labels = [label for label in shape_class.labels if label]
+      for label in labels:
+        parent[_Find(label)] = _Find(labels[0])
+    roots = sorted(set(_Find(c) for c in list(parent)))
+    self._group = {c: roots.index(_Find(c)) for c in parent}
+    rng = random.Random(0)
+    self._keys = [[rng.getrandbits(64) for _ in roots]
+                  for space in range(nrows*ncols)]
+
+  def Placement(self, class_number, orientation, row, col):
+    """The key of a placement: the change to the hash from drawing it."""
+    label = self._classes[class_number].labels[0]
+    h = 0
+    for row_delta, col_delta, c in orientation.cells:
+      space = (row+row_delta)*self._ncols + col+col_delta
+      h ^= self._keys[space][self._group[label or c]]
+    return h
+
+  def Tiling(self, placed):
+    """The hash of the grid _SolvedGrid() draws for placed."""
+    h = 0
+    for placement in placed:
+      h ^= self.Placement(*placement)
+    return h
+
+########################################################################
+# Board symmetry: a rotation or reflection of the board that keeps the
+# blockers in place turns a tiling into another one, as long as the pieces
+# can be turned that way too.  Only one tiling of each such family is
+# searched for.
+
+class BoardSymmetry:
+  """The symmetries of a puzzle.  transforms are dicts mapping (row, col)
+     to (row, col), so they can be pickled for worker processes, identity
+     first, and every orientation of every class is turned into
+     another orientation of the class by each of them.
+
+     The distinguished class, a piece with a shape of its own, is only
+     allowed at the first placement of each family of symmetric ones.  A
+     tiling is canonical if no symmetry leaving that placement alone gives
+     a smaller tiling, or no symmetry at all when no class could be
+     distinguished."""
+
+  def __init__(self, classes, grid, nrows, ncols):
+    self._classes = classes
+    last_row = nrows - 1
+    last_col = ncols - 1
+    transforms = [lambda r, c: (r, c),
+                  lambda r, c: (last_row-r, last_col-c),
+                  lambda r, c: (r, last_col-c),
+                  lambda r, c: (last_row-r, c)]
+    if nrows == ncols:
+      transforms += [lambda r, c: (c, last_row-r),
+                     lambda r, c: (last_col-c, r),
+                     lambda r, c: (c, r),
+                     lambda r, c: (last_col-c, last_row-r)]
+    # The orientation of each class with the given cells.
+    self._orientations = [dict((o.cells, o) for o in shape_class.orientations)
+                          for shape_class in classes]
+    spaces = [(r, c) for r in range(nrows) for c in range(ncols)]
+    self.transforms = []
+    for t in transforms:
+      if (all(grid[r][c].isspace() == grid[t(r, c)[0]][t(r, c)[1]].isspace()
+              for r, c in spaces)
+          and all(self._Find(number, [t(r, c) + (char,)
+                                      for r, c, char in o.cells])
+                  for number, shape_class in enumerate(classes)
+                  for o in shape_class.orientations)):
+        self.transforms.append(dict((space, t(*space)) for space in spaces))
+
+    self.distinguished = None
+    if len(self.transforms) > 1:
+      singles = [number for number, shape_class in enumerate(classes)
+                 if len(shape_class.labels) == 1]
+      if singles:
+        self.distinguished = max(
+            singles, key=lambda number: len(classes[number].orientations))
+
+  def _Turn(self, transform, class_number, orientation, row, col):
+    """The (class number, orientation, row, col) of the placement turned by
+       transform, or None if the class has no such orientation."""
+    return self._Find(class_number,
+                      [transform[row+row_delta, col+col_delta] + (c,)
+                       for row_delta, col_delta, c in orientation.cells])
+
+  def _Find(self, class_number, cells):
+    """The (class number, orientation, row, col) covering the (row, col,
+       char) cells, or None if the class has no such orientation."""
+    new_row = min(r for r, c, char in cells)
+    new_col = min(c for r, c, char in cells)
+    turned = self._orientations[class_number].get(
+        tuple(sorted((r-new_row, c-new_col, char) for r, c, char in cells)))
+    return turned and (class_number, turned, new_row, new_col)
+
+  @staticmethod
+  def _Key(placement):
+    class_number, orientation, row, col = placement
+    return (class_number, row, col, orientation.cells)
+
+  def Allows(self, class_number, orientation, row, col):
+    """Whether the placement is used in the search."""
+    if class_number != self.distinguished:
+      return True
+    placement = (class_number, orientation, row, col)
+    return all(self._Key(placement)
+               <= self._Key(self._Turn(t, *placement))
+               for t in self.transforms)
+
+  def _TurnAll(self, transform, placed):
+    return [self._Turn(transform, *placement) for placement in placed]
+
+  def IsCanonical(self, placed):
+    """Whether a tiling, a list of (class number, orientation, row, col),
+       is the one searched for from its family."""
+    transforms = self.transforms[1:]
+    for placement in placed:
+      if placement[0] == self.distinguished:
+        transforms = [t for t in transforms
+                      if self._Turn(t, *placement) == placement]
+    key = sorted(self._Key(placement) for placement in placed)
+    return all(key <= sorted(self._Key(turned)
+                             for turned in self._TurnAll(t, placed))
+               for t in transforms)
+
+  def Family(self, placed):
+    """The distinct tilings the symmetries turn a tiling into, itself
+       first."""
+    family = {}
+    for t in self.transforms:
+      turned = self._TurnAll(t, placed)
+      family.setdefault(tuple(sorted(self._Key(p) for p in turned)), turned)
+    return list(family.values())
+
+def _Families(tilings, symmetry, expand, grid_hash=None):
+  """Yields (tiling, count, hash) for each canonical (tiling, hash) from the
+     search, count being the number of tilings it stands for.  With expand,
+     each member of its family is yielded instead, with a count of 1 and
+     its hash worked out from grid_hash.  Hashes are 0 without grid_hash."""
+  for tiling, h in tilings:
+    if symmetry.IsCanonical(tiling):
+      family = symmetry.Family(tiling)
+      if expand:
+        # The family starts with the tiling itself.
+        yield family[0], 1, h
+        for member in family[1:]:
+          yield member, 1, grid_hash.Tiling(member) if grid_hash else 0
+      else:
+        yield family[0], len(family), h
+
 ########################################################################
 
-solved_states = set()
 class State:
-  """A partially filled in jigsaw puzzle."""
+  """A partially filled in jigsaw puzzle.
 
-  def __init__(self, pieces, grid, nrows, ncols, next_space_to_fill=None):
-    self._unplaced_pieces = pieces
+     The pieces are given as ShapeClasses.  The filled spaces,
+     blockers included, are an integer bitmask with space (row, col) at bit
+     row*ncols + col.  Every way to put each piece over each space is
+     worked out up front as a mask, so a fit check is one AND, and pieces
+     are placed and removed in place with an OR and an XOR.  A tiling is
+     the list of (class number, orientation, row, col) placed.
+
+     With a GridHash, the hash of the grid the placed pieces draw is kept
+     up to date by XORing in each placement's key as it comes and goes."""
+
+  def __init__(self, classes, grid, nrows, ncols, symmetry, grid_hash=None):
     self._grid = grid
     self._nrows = nrows
     self._ncols = ncols
-    self._next_space_to_fill = next_space_to_fill
-    if not next_space_to_fill:
-      self._next_space_to_fill = [0, 0]
-      self._FindNextSpaceToFill()
+    self._filled = 0
+    for r in range(nrows):
+      for c in range(ncols):
+        if not grid[r][c].isspace():
+          self._filled |= 1 << (r*ncols + c)
+    self._full = (1 << (nrows*ncols)) - 1
+    self._classes = classes
+    self._symmetry = symmetry
+    self._unplaced = [len(shape_class.labels) for shape_class in classes]
+    # (class number, orientation, row, col) of each piece placed, row and
+    # col being the top left corner.
+    self._placed = []
+    self._hash = 0
+    self._fits = self._BuildFits(classes, grid_hash)
+    self._steps = self._BuildSteps(classes)
+    self._sizes = [len(shape_class.orientations[0].cells)
+                   for shape_class in classes]
+    # Bitmask of the region sizes each set of unplaced pieces can fill.
+    self._fillable_sizes = {}
+
+  def _BuildFits(self, classes, grid_hash):
+    """For each space, the (class number, orientation, row, col, mask, key)
+       of each way to cover it with a piece's anchor, avoiding the blockers.
+       key is the placement's GridHash key, or 0 without one."""
+    fits = []
+    for space in range(self._nrows*self._ncols):
+      row, space_col = divmod(space, self._ncols)
+      space_fits = []
+      for class_number, shape_class in enumerate(classes):
+        for orientation in shape_class.orientations:
+          col = space_col - orientation.anchor
+          if (col < 0 or
+              col + len(orientation.rows[0]) > self._ncols or
+              row + len(orientation.rows) > self._nrows):
+            continue
+          mask = 0
+          for row_delta, col_delta, c in orientation.cells:
+            mask |= 1 << ((row+row_delta)*self._ncols + col+col_delta)
+          if (not mask & self._filled and
+              self._symmetry.Allows(class_number, orientation, row, col)):
+            key = (grid_hash.Placement(class_number, orientation, row, col)
+                   if grid_hash else 0)
+            space_fits.append((class_number, orientation, row, col, mask,
+                               key))
+      fits.append(space_fits)
+    return fits
 
+  def _BuildSteps(self, classes):
+    """The (shift, mask) of each step that joins two spaces of a region.
 
-  def PrintSolvedGrid(self):
-    print("SOLUTION:", len(solved_states))
-    for row in range(self._nrows):
-      print("".join(self._grid[row]))
-    print("")
+       The steps are up, down, left and right, plus whatever it takes to
+       join the cells of pieces that only touch diagonally or not at all,
+       so every piece placed lies within one region.  mask is the spaces
+       the step doesn't take off the side of the grid."""
+    steps = set([(0, 1), (0, -1), (1, 0), (-1, 0)])
+    for shape_class in classes:
+      for orientation in shape_class.orientations:
+        cells = [(r, c) for r, c, char in orientation.cells]
+        joined = _Joined(cells, steps)
+        while len(joined) < len(cells):
+          step = min(((r2-r1, c2-c1) for r1, c1 in joined
+                      for r2, c2 in cells if (r2, c2) not in joined),
+                     key=lambda step: abs(step[0]) + abs(step[1]))
+          steps.update([step, (-step[0], -step[1])])
+          joined = _Joined(cells, steps)
 
-  def DeepCopy(self):
-    return State(pieces=list(self._unplaced_pieces),
-                 grid=self._DeepCopyOfGrid(),
-                 nrows=self._nrows, ncols=self._ncols,
-                 next_space_to_fill=self._next_space_to_fill)
+    shifts = []
+    for row_step, col_step in sorted(steps):
+      mask = 0
+      for r in range(self._nrows):
+        for c in range(self._ncols):
+          if 0 <= c + col_step < self._ncols:
+            mask |= 1 << (r*self._ncols + c)
+      shifts.append((row_step*self._ncols + col_step, mask))
+    return shifts
 
-  def _DeepCopyOfGrid(self):
-    new_grid = list()
-    for row in self._grid:
-      new_grid.append(list(row))
-    return new_grid
+  def _NextSpaceToFill(self):
+    """Fill the grid from top left to bottom right, filling each row."""
+    empty = ~self._filled & self._full
+    return (empty & -empty).bit_length() - 1
 
-  def _CanPlacePiece(self, piece):
-    return self._OverlayPiece(piece, mark_piece=False)
+  def Tilings(self):
+    """Yields (tiling, hash) for each tiling below this state.  The state is
+       put back as it was even if the caller stops early."""
+    if not any(self._unplaced):
+      yield tuple(self._placed), self._hash
+      return
 
-  def _PlacePiece(self, piece, unrotated_piece):
-    self._OverlayPiece(piece, mark_piece=True)
-    self._unplaced_pieces.remove(unrotated_piece)
+    if DEBUG:
+      print("Pieces Remaining({})".format(sum(self._unplaced)))
 
-  @staticmethod
-  def _NumberOfLeadingSpacesInFirstRow(piece):
-    count = 0
-    for c in piece[0]:
-      if not c.isspace():
-        return count
-      count += 1
-    return count
-
-  def _OverlayPiece(self, piece, mark_piece):
-    base_row = self._next_space_to_fill[0]
-    base_col = self._next_space_to_fill[1]
-
-    base_col -= self._NumberOfLeadingSpacesInFirstRow(piece)
-    if (base_col < 0 or
-        base_col + len(piece[0]) > self._ncols or
-        base_row + len(piece) > self._nrows):
-      return False
+    for fit in self._fits[self._NextSpaceToFill()]:
+      if self._TryPlace(fit):
+        try:
+          for tiling in self.Tilings():
+            yield tiling
+        finally:
+          self.Remove(fit)
 
-    row_delta = 0
-    for row in piece:
-      col_delta = 0
-      for c in row:
-        if not (c.isspace() or
-                self._grid[base_row+row_delta][base_col+col_delta].isspace()):
-          return False
+  def SplitPaths(self, depth):
+    """Yields the fits placed on the way to each subtree depth pieces down,
+       for PlacePath() to put back in a worker process."""
+    if not depth or not any(self._unplaced):
+      yield ()
+      return
 
-        if mark_piece and not c.isspace():
-          self._grid[base_row+row_delta][base_col+col_delta] = c
+    for fit in self._fits[self._NextSpaceToFill()]:
+      if self._TryPlace(fit):
+        for path in self.SplitPaths(depth-1):
+          yield (fit,) + path
+        self.Remove(fit)
 
-        col_delta += 1
-      row_delta += 1
+  def PlacePath(self, path):
+    for fit in path:
+      self._TryPlace(fit)
 
+  def _TryPlace(self, fit):
+    """Places the fit if it can go on the grid without leaving a region
+       that can't be filled, returning whether it did."""
+    class_number, orientation, row, col, mask, key = fit
+    if not self._unplaced[class_number] or mask & self._filled:
+      return False
+    self._filled |= mask
+    self._hash ^= key
+    self._unplaced[class_number] -= 1
+    self._placed.append((class_number, orientation, row, col))
+    if DEBUG:
+      print("placed {} at ({}, {})".format(orientation.rows, row, col))
+    if not self._RegionsCanBeFilled():
+      self.Remove(fit)
+      return False
     return True
 
-  def _FindNextSpaceToFill(self):
-    row = self._next_space_to_fill[0]
-    col = self._next_space_to_fill[1]
-    while row < self._nrows:
-      while col < self._ncols:
-        if self._grid[row][col].isspace():
-          self._next_space_to_fill = [row, col]
-          return
-        col += 1
-      row += 1
-      col = 0
-
-  def _TryFillNextSpace(self):
-    """Fill the grid from top left to bottom right, filling each row."""
-    for piece in self._unplaced_pieces:
-      self._TryFillNextSpaceWithRotatedPiece(piece, piece)
-      if ALLOW_ROTATED_PIECES:
-        self._TryFillNextSpaceWithRotatedPiece(self._Rotate90(piece), piece)
-        self._TryFillNextSpaceWithRotatedPiece(self._Rotate180(piece), piece)
-        self._TryFillNextSpaceWithRotatedPiece(self._Rotate270(piece), piece)
-
-  def _TryFillNextSpaceWithRotatedPiece(self, piece, unrotated_piece):
-    if self._CanPlacePiece(piece):
-      new_state = self.DeepCopy()
-      new_state._PlacePiece(piece, unrotated_piece)
-      new_state._FindNextSpaceToFill()
-      if DEBUG:
-        print("placed {}".format(piece))
-        PrettyPrinter().pprint(new_state._grid)
-      new_state.Solve()
-    return False
-
-  # Is there a clean way to merge the 90 and 270 rotations?
-  # The method differ by one line.  (And are both written like crap)
-  @staticmethod
-  def _Rotate90(piece):
-    print(piece)
-    #exit(1)
-    nrows = len(piece)
-    ncols = len(piece[0])
-    new_piece = []
-    for c in range(ncols):
-      new_row = [" "] * nrows
-      for r in range(nrows):
-        new_row[r] = piece[nrows-r-1][c]
-      new_piece.append(new_row)
-    return new_piece
+  def Remove(self, fit):
+    """Takes back the last fit placed."""
+    class_number, orientation, row, col, mask, key = fit
+    self._placed.pop()
+    self._unplaced[class_number] += 1
+    self._filled ^= mask
+    self._hash ^= key
 
-  @staticmethod
-  def _Rotate180(piece):
-    new_piece = []
-    for row in reversed(piece):
-      new_piece.append("".join(reversed(row)))
-    return new_piece
+  def _RegionsCanBeFilled(self):
+    """Each connected region of empty spaces has to be filled by some of
+       the unplaced pieces, so its size must be a sum of their sizes."""
+    fillable = self._FillableSizes()
+    empty = ~self._filled & self._full
+    while empty:
+      region = empty & -empty
+      while True:
+        grown = region
+        for shift, mask in self._steps:
+          if shift > 0:
+            grown |= (region & mask) << shift
+          else:
+            grown |= (region & mask) >> -shift
+        grown &= empty
+        if grown == region:
+          break
+        region = grown
+      if not fillable >> _PopCount(region) & 1:
+        return False
+      empty ^= region
+    return True
 
-  @staticmethod
-  def _Rotate270(piece):
-    nrows = len(piece)
-    ncols = len(piece[0])
-    new_piece = []
-    for c in range(ncols):
-      new_row = [" "] * nrows
-      for r in range(nrows):
-        new_row[r] = piece[r][ncols-c-1]
-      new_piece.append(new_row)
-    return new_piece
+  def _FillableSizes(self):
+    unplaced = tuple(self._unplaced)
+    fillable = self._fillable_sizes.get(unplaced)
+    if fillable is None:
+      fillable = 1
+      for size, count in zip(self._sizes, unplaced):
+        for _ in range(count):
+          fillable |= fillable << size
+      self._fillable_sizes[unplaced] = fillable
+    return fillable
+
+
+########################################################################
+# Dancing Links: the puzzle as an exact cover problem.  There is a column
+# for each open space and for each piece with a shape of its own, and a row
+# for each way to put a shape on the grid, covering the columns of its
+# spaces and piece.  The shapes of a class with several pieces have no
+# column; their rows are limited to the number of pieces instead, which
+# only works because the pieces exactly fill the grid.
+
+class DancingLinks:
+  """Knuth's Algorithm X over a sparse 0/1 matrix.  The 1s are nodes in
+     circular doubly linked lists, across each row and down each column,
+     so a column and its rows can be covered and uncovered in place.
+
+     Columns are numbered from 0 and each row is the list of columns it
+     has a 1 in.  Rows can also be put in groups, with at most limits[g]
+     rows of group g in a solution."""
+
+  def __init__(self, ncolumns, rows, groups=None, limits=None):
+    # Node 0 is the root of the list of uncovered column headers, nodes
+    # 1..ncolumns are the headers and the rest are the 1s.
+    nheaders = ncolumns + 1
+    self._left = [i-1 for i in range(nheaders)]
+    self._right = [i+1 for i in range(nheaders)]
+    self._left[0] = ncolumns
+    self._right[ncolumns] = 0
+    self._up = list(range(nheaders))
+    self._down = list(range(nheaders))
+    self._column = list(range(nheaders))
+    self._row = [None] * nheaders
+    self._size = [0] * nheaders
+    self._groups = groups
+    self._remaining = list(limits) if limits else None
+
+    for row_number, columns in enumerate(rows):
+      first = None
+      for column in columns:
+        header = column + 1
+        node = len(self._column)
+        self._column.append(header)
+        self._row.append(row_number)
+        self._size[header] += 1
+        self._up.append(self._up[header])
+        self._down.append(header)
+        self._down[self._up[header]] = node
+        self._up[header] = node
+        if first is None:
+          first = node
+          self._left.append(node)
+          self._right.append(node)
+        else:
+          self._left.append(self._left[first])
+          self._right.append(first)
+          self._right[self._left[first]] = node
+          self._left[first] = node
 
   def Solve(self):
-    if not self._unplaced_pieces:
-      if self not in solved_states:
-        solved_states.add(self)
-        self.PrintSolvedGrid()
+    """Yields the row numbers of each exact cover."""
+    return self._Search([])
+
+  def _Search(self, chosen_rows):
+    right = self._right
+    if not right[0]:
+      yield list(chosen_rows)
       return
 
-    if DEBUG:
-      print("Pieces Remaining({}) {}"
-            .format(len(self._unplaced_pieces), self._unplaced_pieces))
+    # Branch on the column with the fewest rows left.
+    size = self._size
+    column = best = right[0]
+    while column:
+      if size[column] < size[best]:
+        best = column
+      column = right[column]
+    if not size[best]:
+      return
+
+    self._Cover(best)
+    row = self._down[best]
+    while row != best:
+      if self._groups:
+        group = self._groups[self._row[row]]
+        if not self._remaining[group]:
+          row = self._down[row]
+          continue
+        self._remaining[group] -= 1
+      chosen_rows.append(self._row[row])
+      node = right[row]
+      while node != row:
+        self._Cover(self._column[node])
+        node = right[node]
+
+      for solution in self._Search(chosen_rows):
+        yield solution
 
-    _ = self._TryFillNextSpace()
+      node = self._left[row]
+      while node != row:
+        self._Uncover(self._column[node])
+        node = self._left[node]
+      chosen_rows.pop()
+      if self._groups:
+        self._remaining[group] += 1
+      row = self._down[row]
+    self._Uncover(best)
 
+  def _Cover(self, header):
+    left, right, up, down = self._left, self._right, self._up, self._down
+    right[left[header]] = right[header]
+    left[right[header]] = left[header]
+    row = down[header]
+    while row != header:
+      node = right[row]
+      while node != row:
+        up[down[node]] = up[node]
+        down[up[node]] = down[node]
+        self._size[self._column[node]] -= 1
+        node = right[node]
+      row = down[row]
 
-  def __eq__(self, other):
-    return self.__hash__() == other.__hash__()
+  def _Uncover(self, header):
+    left, right, up, down = self._left, self._right, self._up, self._down
+    row = up[header]
+    while row != header:
+      node = left[row]
+      while node != row:
+        self._size[self._column[node]] += 1
+        up[down[node]] = node
+        down[up[node]] = node
+        node = left[node]
+      row = up[row]
+    right[left[header]] = header
+    left[right[header]] = header
 
-  def __hash__(self):
-    # Only care about the grid
-    h = ""
-    for r in self._grid:
-      h += "".join(r)
-    return hash(h)
+def _ExactCoverRows(classes, grid, nrows, ncols, symmetry):
+  """Returns the number of columns, the matrix rows, the class number of
+     each row and the (class number, orientation, row, col) each one puts
+     on the grid, with row and col the top left corner."""
+  columns = {}
+  for class_number, shape_class in enumerate(classes):
+    if len(shape_class.labels) == 1:
+      columns[class_number] = len(columns)
+  for r in range(nrows):
+    for c in range(ncols):
+      if grid[r][c].isspace():
+        columns[(r, c)] = len(columns)
+
+  rows = []
+  groups = []
+  placements = []
+  for class_number, shape_class in enumerate(classes):
+    piece_columns = ([columns[class_number]]
+                     if class_number in columns else [])
+    for orientation in shape_class.orientations:
+      for base_row in range(nrows - len(orientation.rows) + 1):
+        for base_col in range(ncols - len(orientation.rows[0]) + 1):
+          space_columns = [
+              columns.get((base_row+row_delta, base_col+col_delta))
+              for row_delta, col_delta, c in orientation.cells]
+          if (None not in space_columns and
+              symmetry.Allows(class_number, orientation, base_row, base_col)):
+            rows.append(piece_columns + space_columns)
+            groups.append(class_number)
+            placements.append((class_number, orientation, base_row, base_col))
+  return len(columns), rows, groups, placements
+
+def _DancingLinksTilings(classes, grid, nrows, ncols, symmetry,
+                         grid_hash=None):
+  """Yields (tiling, hash) for each tiling Dancing Links finds, the hash
+     being 0 without a GridHash."""
+  ncolumns, rows, groups, placements = _ExactCoverRows(classes, grid,
+                                                       nrows, ncols, symmetry)
+  keys = [grid_hash.Placement(*placement) if grid_hash else 0
+          for placement in placements]
+  limits = [len(shape_class.labels) for shape_class in classes]
+  for solution in DancingLinks(ncolumns, rows, groups, limits).Solve():
+    h = 0
+    for row in solution:
+      h ^= keys[row]
+    yield [placements[row] for row in solution], h
+
+
+########################################################################
+# Parallel search: the first SPLIT_DEPTH pieces are placed here and each
+# resulting subtree is searched by a pool worker.
+
+_worker_state = None
+def _InitWorker(state):
+  global _worker_state
+  _worker_state = state
+
+def _SolveSubtree(path, symmetry, expand, max_solutions, count_only,
+                  grid_hash):
+  """Worker task.  Returns (tiling, count, hash) for each tiling under path,
+     with None for the tiling when count_only is set."""
+  results = []
+  ntilings = 0
+  _worker_state.PlacePath(path)
+  families = _Families(_worker_state.Tilings(), symmetry, expand, grid_hash)
+  for tiling, count, h in families:
+    results.append((None if count_only else tiling, count, h))
+    ntilings += count
+    if max_solutions and ntilings >= max_solutions:
+      break
+  families.close()  # Takes back the tiling it stopped in.
+  for fit in reversed(path):
+    _worker_state.Remove(fit)
+  return results
+
+def _ParallelFamilies(state, symmetry, expand, processes, max_solutions,
+                      count_only, grid_hash):
+  """Yields what _Families() would for the state's tilings, searching the
+     subtrees in a process pool.  The pool is stopped when the caller
+     stops.
+
+     Subtrees are handed out one at a time as workers free up, since their
+     sizes vary wildly."""
+  paths = list(state.SplitPaths(SPLIT_DEPTH))
+  task = functools.partial(_SolveSubtree, symmetry=symmetry, expand=expand,
+                           max_solutions=max_solutions, count_only=count_only,
+                           grid_hash=grid_hash)
+  with multiprocessing.Pool(processes or None, initializer=_InitWorker,
+                            initargs=(state,)) as pool:
+    for results in pool.imap_unordered(task, paths, chunksize=1):
+      for result in results:
+        yield result
+
+
+########################################################################
+# Solving
+
+def Solutions(pieces, grid, allow_rotation=True, allow_reflection=False,
+              max_solutions=0, count_only=False, expand=False,
+              dancing_links=False, processes=1):
+  """A generator of (rows, count) for each solution of the puzzle as it is
+     found.
+
+     grid is a list of strings, with any non-space char blocking its space,
+     and rows is the solved grid as a tuple of strings.  count is the
+     number of tilings the solution stands for: 1, or with expand off, the
+     size of its family of rotations and reflections.  Tilings that draw
+     the same grid, from pieces drawn with the same char side by side, are
+     only drawn once: the repeats are yielded with rows of None, so the
+     counts add up the same with or without count_only.
+
+     The search stops once max_solutions tilings have been counted (0 is no
+     limit).  With count_only, rows is None, no grids are built and every
+     tiling is counted.  Only the worked out orientations of recent pieces
+     are kept between calls, so any number can run at once.
+
+     Raises ValueError straight away, rather than when the solutions are
+     first asked for, if the pieces don't exactly fill the open spaces."""
+  if _SumOfPieceSizes(pieces) != _SpacesInStartingGrid(grid):
+    raise ValueError("Pieces will not exactly fill grid which has {} "
+                     "spaces.".format(_SpacesInStartingGrid(grid)))
+  return _Solutions(pieces, grid, allow_rotation, allow_reflection,
+                    max_solutions, count_only, expand, dancing_links,
+                    processes)
+
+def _Solutions(pieces, grid, allow_rotation, allow_reflection, max_solutions,
+               count_only, expand, dancing_links, processes):
+  """The search behind Solutions(), once the puzzle has been checked."""
+  nrows = len(grid)
+  ncols = len(grid[0])
+  classes = _ShapeClasses(pieces, allow_rotation, allow_reflection)
+  symmetry = BoardSymmetry(classes, grid, nrows, ncols)
+
+  # Repeated grids need a shared draw char.  With one, the search keeps each
+  # tiling's grid hash as it goes, and a grid is only compared with the
+  # grids drawn before it that hash the same.
+  grid_hash = None
+  if not count_only and _SharesDrawChars(classes):
+    grid_hash = GridHash(classes, nrows, ncols)
+  if dancing_links:
+    families = _Families(
+        _DancingLinksTilings(classes, grid, nrows, ncols, symmetry, grid_hash),
+        symmetry, expand, grid_hash)
+  else:
+    state = State(classes=classes, grid=grid, nrows=nrows, ncols=ncols,
+                  symmetry=symmetry, grid_hash=grid_hash)
+    if processes == 1:
+      families = _Families(state.Tilings(), symmetry, expand, grid_hash)
+    else:
+      families = _ParallelFamilies(state, symmetry, expand, processes,
+                                   max_solutions, count_only, grid_hash)
+
+  ntilings = 0
+  seen = {}  # {grid hash: [rows]}
+  for tiling, count, h in families:
+    ntilings += count
+    if count_only:
+      yield None, count
+    else:
+      rows = tuple("".join(row) for row in _SolvedGrid(grid, classes, tiling))
+      if grid_hash:
+        same_hash = seen.setdefault(h, [])
+        if rows in same_hash:
+          rows = None
+        else:
+          same_hash.append(rows)
+      yield rows, count
+    if max_solutions and ntilings >= max_solutions:
+      return
+
+def CountSolutions(pieces, grid, allow_rotation=True, allow_reflection=False,
+                   max_solutions=0):
+  """The number of tilings of the puzzle, or max_solutions if there are at
+     least that many.  CountSolutions(..., max_solutions=2) == 1 checks a
+     puzzle has just one solution."""
+  ntilings = sum(count for rows, count in Solutions(
+      pieces, grid, allow_rotation, allow_reflection,
+      max_solutions=max_solutions, count_only=True))
+  return min(ntilings, max_solutions) if max_solutions else ntilings
 
 
 ########################################################################
@@ -248,8 +945,8 @@ def _SumOfPieceSizes(pieces):
     total += _SizeOfPiece(piece)
   return total
 
-def _CreateEmptyGrid():
-  return [[' ' for c in range(COL_COUNT)] for r in range(ROW_COUNT)]
+def _CreateEmptyGrid(nrows, ncols):
+  return [[' ' for c in range(ncols)] for r in range(nrows)]
 
 def _PrintStartingState():
   print("{}x{} with {} Pieces, needing a total of {} spaces."
@@ -267,23 +964,126 @@ def _PrintStartingState():
     print()
 
 ########################################################################
+# Batch mode
+
+def _SolvePuzzleLine(task, max_solutions, count_only, expand, dancing_links):
+  """Batch task.  Returns the JSON-able result for one puzzle line."""
+  name, line = task
+  start = time.perf_counter()
+  try:
+    puzzle = json.loads(line)
+    name = puzzle.get("name", name)
+    grid = puzzle.get("grid") or _CreateEmptyGrid(puzzle["rows"],
+                                                  puzzle["cols"])
+    pieces = puzzle["pieces"]
+    allow_rotation = puzzle.get("rotate", True)
+    allow_reflection = puzzle.get("reflect", False)
+    solutions = []
+    ntilings = 0
+    for rows, count in Solutions(pieces, grid, allow_rotation,
+                                 allow_reflection, max_solutions, count_only,
+                                 expand, dancing_links):
+      ntilings += count
+      if rows:
+        solutions.append(rows)
+    classes = _ShapeClasses(pieces, allow_rotation, allow_reflection)
+  except puzzle_batch.PUZZLE_ERRORS as e:
+    return puzzle_batch.ErrorResult(name, e)
+
+  result = {"name": name, "count": ntilings,
+            "labelled": ntilings * _LabelledTilingsPerTiling(classes)}
+  if max_solutions:
+    result["capped"] = ntilings >= max_solutions
+  if not count_only:
+    result["solutions"] = solutions
+  result["seconds"] = round(time.perf_counter() - start, 6)
+  return result
+
+########################################################################
+def _ParseCommandLineArguments(argv):
+  parser = argparse.ArgumentParser(
+      formatter_class=argparse.RawTextHelpFormatter,
+      description=__doc__)
+
+  puzzle_batch.AddArguments(parser, "tilings")
+
+  parser.add_argument("--dancing_links", "-x", action="store_true",
+      help="Solve as an exact cover problem with Dancing Links, instead of"
+           "\nfilling the grid from the top left.")
+
+  parser.add_argument("--expand_symmetric", "-e", action="store_true",
+      help="Print every rotation and reflection of each tiling the board"
+           "\nallows.  By default only one of each family is searched for"
+           "\nand printed, though all of them are counted.")
+
+  parser.add_argument("--processes", "-p", type=int, default=PROCESSES,
+      help="Worker processes; 1 runs in this process, 0 uses every core."
+           "\nOnly the fill search uses them for a single puzzle."
+           "\nDefault: %d" % PROCESSES)
+
+  args = parser.parse_args(argv[1:])
+  if args.dancing_links and args.processes != 1 and not args.puzzles:
+    parser.error("--processes only works with the fill search")
+  puzzle_batch.ApplyLimits(args)
+
+  return args
+
 def main():
   """Solves a jigsaw puzzle, printing all solutions as they are found.
-     The initial puzzle specification must be entered at the top of this file.
+     Identical pieces are told apart by their characters, but each tiling
+     is only printed once, with a count of its labellings at the end.
+     The initial puzzle specification must be entered at the top of this file,
+     unless a puzzle file is given.
   """
+  args = _ParseCommandLineArguments(sys.argv)
+  if args.puzzles:
+    # Each worker keeps the piece orientations it has worked out for later
+    # puzzles.
+    solve = functools.partial(
+        _SolvePuzzleLine, max_solutions=args.max_solutions,
+        count_only=args.count_only, expand=args.expand_symmetric,
+        dancing_links=args.dancing_links)
+    with puzzle_batch.OpenOutput(args.output) as output:
+      puzzle_batch.SolveBatch(args.puzzles, args.processes, output, solve)
+    return
+
   _PrintStartingState()
 
-  grid = GRID if GRID else _CreateEmptyGrid()
+  grid = GRID if GRID else _CreateEmptyGrid(ROW_COUNT, COL_COUNT)
 
-  if not _SumOfPieceSizes(PIECES) == _SpacesInStartingGrid(grid):
-    print("ERROR: Pieces will not exactly fill grid which has {} spaces."
-          .format(_SpacesInStartingGrid(grid)))
+  try:
+    solutions = Solutions(
+        PIECES, grid, ALLOW_ROTATED_PIECES, ALLOW_REFLECTED_PIECES,
+        max_solutions=args.max_solutions, count_only=args.count_only,
+        expand=args.expand_symmetric, dancing_links=args.dancing_links,
+        processes=args.processes)
+  except ValueError as e:
+    print("ERROR:", e)
     sys.exit(1)
 
-  # Solutions are printed as they are found.
-  State(pieces=PIECES, grid=grid, nrows=ROW_COUNT, ncols=COL_COUNT).Solve()
+  # Solutions are printed as they are found, with one labelling of each
+  # tiling of shapes.
+  nsolutions = 0
+  ntilings = 0
+  for rows, count in solutions:
+    ntilings += count
+    if rows:
+      nsolutions += 1
+      print("SOLUTION:", nsolutions)
+      for row in rows:
+        print(row)
+      print("")
 
-  print("No (more) solutions.")
+  if args.unique:
+    print("Solutions:", ["none", "unique", "multiple"][min(ntilings, 2)])
+    return
+  if args.max_solutions and ntilings >= args.max_solutions:
+    print("Stopped after {} tilings.".format(ntilings))
+  else:
+    print("No (more) solutions.")
+  classes = _ShapeClasses(PIECES, ALLOW_ROTATED_PIECES, ALLOW_REFLECTED_PIECES)
+  print("Tilings: {} shape-distinct, {} labelled."
+        .format(ntilings, ntilings * _LabelledTilingsPerTiling(classes)))
 
 if __name__ == '__main__':
   main()
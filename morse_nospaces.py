@@ -9,7 +9,9 @@
 
 from pprint import PrettyPrinter
 from collections import defaultdict
-import argparse, heapq, re, sys
+import argparse, heapq, itertools, math, re, sys
+
+from word_trie import WordTrie
 
 # From: http://norvig.com/ngrams/count_1w.txt
 DICT_BY_FREQ_FILE = "./google-books-common-words.txt"
@@ -65,171 +67,212 @@ def _LoadFreqWords(dict_file):
     return freq_map
 
 
-def _AllStringsThatBecomeWords(words):
-    """Returns a set of all strings that are a prefix for a word in words.
+def _WordsByMorse(words):
+    """Returns {morse: [words with that morse]}.
 
-    e.g. the strings added for the word skill are: s, sk, ski, skil.
+    Words with letters that have no morse are left out.
+    e.g. E, I and EE become {'.': ['E'], '..': ['EE', 'I']}
     """
-    return set(word[:i+1] for word in words for i in xrange(len(word)))
-
-
-def _CharacterTransitionMap(morse_msg):
-    """Construct a map of possible char transitions.
+    words_by_morse = defaultdict(list)
+    for word in sorted(words):
+        if all(c in MORSE for c in word):
+            words_by_morse["".join(MORSE[c] for c in word)].append(word)
+    return words_by_morse
 
-    Return [{char starting there, index of start of next char}]
-    e.g. '..' becomes [{'I': 2, 'E': 1}, {'E': 2}]
-    """
-    result = [{} for i in xrange(len(morse_msg))]
-    for i in xrange(len(morse_msg)):
-        for c, m in MORSE.iteritems():
-            if morse_msg[i:i+len(m)] == m:
-              result[i][c] = i + len(m)
-    return result
-
-
-def _GenerateWords(words, prefixes, ctm, i, prefix=''):
-    """Generate all possible words starting with prefix, and continuing from
-    from position i in the char transition map (ctm).
-    """
-    if prefix in words:
-        yield prefix, i
-    if i == len(ctm):
-        return
-    for c, j in ctm[i].iteritems():
-        if prefix + c in prefixes:
-            for w, j2 in _GenerateWords(words, prefixes, ctm, j, prefix + c):
-                yield w, j2
 
-
-def _WordTransitionMap(words, prefixes, morse_msg):
+def _WordTransitionMap(words_by_morse, morse_trie, morse_msg):
     """Construct a map of possible word transitions.
 
     Returns [{next_index: [words_ending_at_next_index-1]}]
     If no words start at next_index, no entry is created for key next_index.
     """
-
-    # MorseChar[{char starting there, index of start of next char}]
-    ctm = _CharacterTransitionMap(morse_msg)
-
-    result = [{} for i in xrange(len(ctm))]
-    for i_ in xrange(len(ctm)):
-        i = len(ctm) - i_ - 1
-        for w, j in _GenerateWords(words, prefixes, ctm, i):
+    result = [{} for i in xrange(len(morse_msg))]
+    for i_ in xrange(len(morse_msg)):
+        i = len(morse_msg) - i_ - 1
+        # Follow the morse from i, picking up the words that end on the way.
+        node = WordTrie.ROOT
+        for j in xrange(i + 1, len(morse_msg) + 1):
+            node = morse_trie.Walk(node, morse_msg[j-1])
+            if node is None:
+                break
+            if not morse_trie.IsWord(node):
+                continue
             if j < len(result) and not result[j]:
                 continue
-            if j in result[i]:
-                result[i][j].append(w)
-            else:
-                result[i][j] = [w]
+            result[i][j] = words_by_morse[morse_msg[i:j]]
     return result
 
 
-def _nSentencesInWordMap(wtm):
-    """Return the number of valid word sequence in wtm"""
-    result = [0] * len(wtm) + [1]
-    for i_ in xrange(len(wtm)):
-        i = len(wtm) - i_ - 1
-        for j in wtm[i].iterkeys():
-            result[i] += result[j]
-    return result[0]
-
-
-def _nWordsInShortestSentence(wtm):
-    """Return the length of the shortest sentence that solves the morse code"""
-
-    min_to_index = [0] + [sys.maxsize] * len(wtm)
+class WordLattice(object):
+    """The ways to split a morse message into words, as a DAG.
 
-    for i in xrange(len(wtm)):
-        for end_index, _ in wtm[i].iteritems():
-            if min_to_index[end_index] > min_to_index[i] + 1:
-                min_to_index[end_index] = min_to_index[i] + 1
+    The nodes are the indexes into the message, 0 to len(message). edges[i]
+    maps each j to the words whose morse is message[i:j], most frequent
+    first. No edge leads to a node that can't reach the end.
 
-    length = min_to_index[len(wtm)]
-    return length if length != sys.maxsize else 0
+    A complex sentence is a path from 0 to the end, given as a tuple of the
+    word choices for each of its edges.
+    e.g. (['NUMBERED'], ['IDS', 'INES'], ['SOLUTION'])
 
-
-def _SolutionsOfLength(num_words, words_by_freq, wtm, wtm_index=0):
-    """Return all solutions in <wtm> of <num_words>, starting from <wtm_index>.
+    A sentence is scored as the sum of the log frequencies of its words.
+    Words missing from words_by_freq count as seen once.
     """
 
-    def _SortWordsByFreq(words_by_freq, words):
+    def __init__(self, wtm, words_by_freq):
         def _Freq(word):
             return words_by_freq.get(word) or 0
-        return sorted(words, key=_Freq, reverse=True)
-
-    if num_words == 0 or wtm_index == len(wtm):
-        return []
-
-    results = []
-
-    # Prefer solutions that consume more more chars at a time
-    # -- This may be unecessary with "Most Likely Solutions"
-    for end_index, words in reversed(sorted(wtm[wtm_index].items())):
-        if end_index == len(wtm) and num_words == 1:
-            results.append("%s" % _SortWordsByFreq(words_by_freq, words))
-            continue
-
-        for r in _SolutionsOfLength(num_words-1, words_by_freq, wtm, end_index):
-            results.append("%s %s" % (_SortWordsByFreq(words_by_freq, words), r))
-            # The following nested array structure, while nicer is 8x slower.
-            # results.append([_SortWordsByFreq(words_by_freq, words), r])
-
-    return results
-
-
-def _MostLikelySolutions(sentences, number_to_print, words_by_freq):
-    """Return the top <number_to_print solutions>, scored as the
-       multiplicitive sum of word_freq(word in sentence).
-
-       First pass impl: Return at most 1 sentence per complex sentence.
 
-       Sample input line: ['NUMBERED'] ['IDS', 'INES', 'ERSE'] ['SOLUTION']
-    """
-    results = {}
-    for complex_sentence in sentences:
-        score = 1
-        simple_sentence = ""
-        for word_choice_set in complex_sentence[1:-1].split("] ["):
-            # Words in each choice set are already sorted by frequency
-            best_word = word_choice_set.split(", ")[0][1:-1]
-            score *= words_by_freq.get(best_word) or 0
-            simple_sentence += best_word + " "
-        results[simple_sentence.strip()] = score
-    return heapq.nlargest(number_to_print, results, key=results.get)
-
-
-def _ComplexSentenceAsFlatList(complex_sentence, prefix=""):
-    """Expand complex_sentence into a flat list of strings
-
-       e.g. ['NUMBERED'] ['IDS', 'INES'] ['SOLUTION']
-       to ['NUMBERED ID SOLUTION', 'NUMBERED INES SOLUTION']
-    """
-    results = []
+        self.edges = [dict((j, sorted(words, key=_Freq, reverse=True))
+                           for j, words in edges.iteritems())
+                      for edges in wtm]
+        self._words_by_freq = words_by_freq
+        self._log_total = math.log(sum(words_by_freq.itervalues()) or 1)
+
+    def CountSentences(self):
+        """Return the number of paths through the lattice."""
+        result = [0] * len(self.edges) + [1]
+        for i in reversed(xrange(len(self.edges))):
+            for j in self.edges[i].iterkeys():
+                result[i] += result[j]
+        return result[0]
+
+    def ShortestSentenceLength(self):
+        """Return the number of words in the shortest path, 0 if none."""
+        min_to_index = [0] + [sys.maxsize] * len(self.edges)
+        for i in xrange(len(self.edges)):
+            for j in self.edges[i].iterkeys():
+                if min_to_index[j] > min_to_index[i] + 1:
+                    min_to_index[j] = min_to_index[i] + 1
+
+        length = min_to_index[len(self.edges)]
+        return length if length != sys.maxsize else 0
+
+    def Sentences(self, num_words, index=0):
+        """Yield the complex sentences of <num_words> from <index> to the end.
+        """
+        if num_words == 0 or index == len(self.edges):
+            return
+
+        # Prefer solutions that consume more more chars at a time
+        # -- This may be unecessary with "Most Likely Solutions"
+        for end_index, words in sorted(self.edges[index].items(),
+                                       reverse=True):
+            if end_index == len(self.edges) and num_words == 1:
+                yield (words,)
+                continue
 
-    next_start = complex_sentence[1:].find('[')
-    if next_start == -1:
-        if complex_sentence[0] == '[':
-          results.append("%s" % (prefix + complex_sentence[1:-1]))
-        else:
-          results.append("%s" % (prefix + complex_sentence))
+            for rest in self.Sentences(num_words - 1, end_index):
+                yield (words,) + rest
+
+    def _Score(self, word):
+        return math.log(self._words_by_freq.get(word) or 1) - self._log_total
+
+    def MostLikelySentences(self, number, num_words=None):
+        """Return the top <number> sentences, best first. With <num_words>,
+        only sentences of that many words are considered.
+
+        This is a k-best paths search. A node is an index into the message,
+        with the number of words still to place when num_words is given.
+        Each node has a heap of candidates for its next best path to the end:
+        an edge and word, followed by one of the successor's paths. Paths are
+        only worked out when asked for. Before the next one is taken, the
+        last one taken is replaced by the candidate using the successor's
+        next path and, if it used the successor's best path, the one using
+        the next word on the edge.
+        """
+        length = len(self.edges)
+        if not length:
+            return []
+
+        def _Next(node, j):
+            """The node an edge from node to j leads to, or None."""
+            i, words_left = node
+            if words_left is None:
+                return (j, None)
+            if (j == length) != (words_left == 1):
+                return None
+            return (j, words_left - 1)
+
+        # {node: [(score, j, word index, rank of the successor's path)]}
+        paths = {}
+        # {node: heap of (-score, j, word index, rank of the successor's path)}
+        candidates = {}
+        # {node: (j, word index, rank) of the last path taken}
+        last_taken = {}
+
+        def _Push(node, j, word_index, rank):
+            words = self.edges[node[0]][j]
+            if word_index == len(words):
+                return
+            path = _Path(_Next(node, j), rank)
+            if path:
+                score = self._Score(words[word_index]) + path[0]
+                heapq.heappush(candidates[node], (-score, j, word_index, rank))
+
+        def _Path(node, rank):
+            """The rank'th best path from node to the end, or None."""
+            node_paths = paths[node]
+            heap = candidates[node]
+            while len(node_paths) <= rank:
+                if node in last_taken:
+                    j, word_index, next_rank = last_taken.pop(node)
+                    _Push(node, j, word_index, next_rank + 1)
+                    if next_rank == 0:
+                        _Push(node, j, word_index + 1, 0)
+                if not heap:
+                    return None
+                score, j, word_index, next_rank = heapq.heappop(heap)
+                node_paths.append((-score, j, word_index, next_rank))
+                last_taken[node] = (j, word_index, next_rank)
+            return node_paths[rank]
+
+        # Seed the candidates from the end back, so finding the best paths
+        # (Viterbi) never recurses deeper than one edge.
+        end = (length, 0 if num_words else None)
+        paths[end] = [(0.0, None, None, None)]
+        candidates[end] = []
+        all_words_left = xrange(1, num_words + 1) if num_words else [None]
+        for i in reversed(xrange(length)):
+            for words_left in all_words_left:
+                node = (i, words_left)
+                paths[node] = []
+                candidates[node] = []
+                for j in self.edges[i]:
+                    if _Next(node, j) in paths:
+                        _Push(node, j, 0, 0)
+
+        start = (0, num_words or None)
+        results = []
+        for rank in xrange(number):
+            if not _Path(start, rank):
+                break
+            sentence = []
+            node, path_rank = start, rank
+            while node != end:
+                _, j, word_index, path_rank = _Path(node, path_rank)
+                sentence.append(self.edges[node[0]][j][word_index])
+                node = _Next(node, j)
+            results.append(" ".join(sentence))
         return results
 
-    choice_set = complex_sentence[:next_start]
-    rest = complex_sentence[next_start+1:]
+    @staticmethod
+    def Flatten(sentence):
+        """Return every sentence a complex sentence stands for.
 
-    for choice in choice_set[1:-1].split(", "):
-        results.extend(_ComplexSentenceAsFlatList(rest, prefix+choice+" "))
-    return results
+        e.g. (['NUMBERED'], ['IDS', 'INES'], ['SOLUTION'])
+        to ['NUMBERED IDS SOLUTION', 'NUMBERED INES SOLUTION']
+        """
+        return [" ".join(words) for words in itertools.product(*sentence)]
 
 
-def _PrintAllSolutions(solutions, print_as_flat_list=False):
-    for s in solutions:
-        s = s.replace("'","")
+def _PrintAllSolutions(sentences, print_as_flat_list=False):
+    for sentence in sentences:
         if print_as_flat_list:
-            pprint(_ComplexSentenceAsFlatList(s))
+            pprint(WordLattice.Flatten(sentence))
             print ""
         else:
-            print "  " + s
+            print "  " + " ".join("[%s]" % ", ".join(words)
+                                  for words in sentence)
 
 
 def _ParseCommandLineArguments(argv):
@@ -255,6 +298,12 @@ def _ParseCommandLineArguments(argv):
     parser.add_argument("++list", "+l", action="store_true",
         help="Print all solutions as a flat list (slow if max>6).")
 
+    parser.add_argument("++most_likely", "+k", type=int, default=10,
+        help="# of most likely solutions to show.")
+
+    parser.add_argument("++most_likely_only", "+o", action="store_true",
+        help="Only show the most likely solutions (for long messages).")
+
     parser.add_argument("++max", "+m", type=int, default=0,
         help="Max # of words in solution. [0: Min # of word solutions]")
 
@@ -297,13 +346,16 @@ def Main():
     use_full_dict = args.allow_rare_words
 
     print_as_flat_list = args.list
+    most_likely = args.most_likely
 
     # Load Word lists
     words_by_freq = _LoadFreqWords(freq_file)
     words = _LoadWords(dict_file)
     if not use_full_dict:
         words = set.intersection(words, words_by_freq.keys())
-    prefixes = _AllStringsThatBecomeWords(words)
+    words_by_morse = _WordsByMorse(words)
+    # A trie of the morse of every word, to find them in the message.
+    morse_trie = WordTrie(words_by_morse)
 
     # Output starting state
     print "input:", morse_msg
@@ -311,11 +363,16 @@ def Main():
         print "Using the full dictionary ('rare' words)."
 
     # MorseCharacter[{next_index: [words_ending_at_next_index-1]}]
-    word_transition_map = _WordTransitionMap(words, prefixes, morse_msg)
+    word_transition_map = _WordTransitionMap(words_by_morse, morse_trie,
+                                             morse_msg)
+    lattice = WordLattice(word_transition_map, words_by_freq)
 
-    min_sentence_len = _nWordsInShortestSentence(word_transition_map)
+    min_sentence_len = lattice.ShortestSentenceLength()
     print "Shortest sentence: %d words; Number of possible sentences: %d" \
-         % (min_sentence_len, _nSentencesInWordMap(word_transition_map))
+         % (min_sentence_len, lattice.CountSentences())
+
+    print "\nMost likely solutions of any length\n  ",
+    pprint(lattice.MostLikelySentences(most_likely))
 
     # Print solutions for each length as we go. 7+ word solutions are slow
     if not max_solution_len:
@@ -323,13 +380,12 @@ def Main():
 
     for i in xrange(min_sentence_len, max_solution_len+1):
         print "\nSolutions of length %d" % i
-        solutions = _SolutionsOfLength(i, words_by_freq, word_transition_map)
-
         print " -- Most likely solutions\n  ",
-        pprint(_MostLikelySolutions(solutions, 10, words_by_freq))
+        pprint(lattice.MostLikelySentences(most_likely, i))
 
-        print "\n -- All solutions"
-        _PrintAllSolutions(solutions, print_as_flat_list)
+        if not args.most_likely_only:
+            print "\n -- All solutions"
+            _PrintAllSolutions(lattice.Sentences(i), print_as_flat_list)
 
 
 if __name__ == '__main__':
@@ -0,0 +1,91 @@
+"""Batch mode shared by the puzzle solvers.
+
+A batch is a JSONL puzzle file, or a directory of *.jsonl files, with one
+JSON puzzle per line.  Each solver turns a puzzle line into a JSON-able
+result, and one result line is written for each puzzle as it finishes.  A
+line that can't be read as a puzzle gets an error entry instead of stopping
+the batch.
+"""
+
+import contextlib
+import json
+import multiprocessing
+import os
+import sys
+
+# What a bad puzzle line can raise while it is read and set up.
+PUZZLE_ERRORS = (ValueError, KeyError, TypeError, AttributeError, IndexError)
+
+
+def AddArguments(parser, things="solutions"):
+  """Adds the batch and search limit flags, things being what is counted."""
+  parser.add_argument("puzzles", nargs='?',
+      help="A JSONL puzzle file or a directory of *.jsonl files."
+           "\nWithout one, the puzzle at the top of this file is solved.")
+
+  parser.add_argument("--output", "-o",
+      help="Where to write batch results. Default: stdout")
+
+  parser.add_argument("--max_solutions", "-m", type=int, default=0,
+      help="Stop the search after this many %s. Default: no limit" % things)
+
+  parser.add_argument("--first", "-f", action="store_true",
+      help="Stop at the first solution. Same as --max_solutions 1.")
+
+  parser.add_argument("--count_only", "-c", action="store_true",
+      help="Count the %s without printing them." % things)
+
+  parser.add_argument("--unique", "-u", action="store_true",
+      help="Only check for zero, one, or multiple %s."
+           "\nSame as --count_only --max_solutions 2." % things)
+
+def ApplyLimits(args):
+  """Folds --first and --unique into the limits they stand for."""
+  if args.first:
+    args.max_solutions = 1
+  if args.unique:
+    args.count_only = True
+    args.max_solutions = 2
+
+def OpenOutput(path):
+  """A context manager for the results file, or stdout without a path."""
+  return open(path, "w") if path else contextlib.nullcontext(sys.stdout)
+
+def ReadPuzzles(path):
+  """Yields (name, line) for each puzzle line of the file, or of every
+     *.jsonl file in the directory.  The name is used when the puzzle has
+     none."""
+  if os.path.isdir(path):
+    paths = sorted(os.path.join(path, f) for f in os.listdir(path)
+                   if f.endswith(".jsonl")
+                   and os.path.isfile(os.path.join(path, f)))
+  else:
+    paths = [path]
+  for puzzle_file in paths:
+    with open(puzzle_file) as f:
+      for line_number, line in enumerate(f, 1):
+        if line.strip():
+          yield "{}:{}".format(puzzle_file, line_number), line
+
+def ErrorResult(name, error):
+  """The result line for a puzzle that raised one of PUZZLE_ERRORS."""
+  return {"name": name, "error": "{}: {}".format(type(error).__name__, error)}
+
+def SolveBatch(path, processes, output, solve):
+  """Solves every puzzle under path with solve((name, line)), writing a JSON
+     line as each finishes.  Each worker solves whole puzzles, one at a
+     time.  solve must be picklable when processes isn't 1."""
+  tasks = ReadPuzzles(path)
+  if processes == 1:
+    results = map(solve, tasks)
+    pool = None
+  else:
+    pool = multiprocessing.Pool(processes or None)
+    results = pool.imap_unordered(solve, tasks, chunksize=1)
+  try:
+    for result in results:
+      output.write(json.dumps(result) + "\n")
+      output.flush()
+  finally:
+    if pool:
+      pool.terminate()
@@ -35,6 +35,8 @@ from typing import NamedTuple
 
 import argparse, copy, random, sys
 
+from word_trie import WordTrie
+
 DEBUG = False
 DICT_FILE = "/usr/share/dict/words"
 HUGE_DICT_FILE = "/usr/share/dict/american-english-huge"
@@ -42,8 +44,7 @@ INSANE_DICT_FILE = "/usr/share/dict/american-english-insane"
 
 @dataclass
 class Dicts:
-    words: set
-    prefixes: set
+    words: WordTrie
 
 @dataclass
 class Preferences:
@@ -81,15 +82,6 @@ def _LoadWords(dict_file):
 
     return words
 
-def _WordPrefixes(words):
-    """Returns a set with all the strings that can become longer words."""
-    word_prefixes =  set()
-    for word in words:
-        for i in range(len(word)-1):
-          word_prefixes.add(word[:i+1])
-    return word_prefixes
-
-
 def _FindCommonNgrams(ngrams, solutions):
     pass
 
@@ -105,7 +97,8 @@ def _ExtractLongWords(ngrams, lengths, preferences, dicts):
         if length in length_to_ngrams:
             continue
             solutions = set()
-            _FindEnumeratedSeq(new_word="", next_ngram="",
+            _FindEnumeratedSeq(new_word="", word_node=WordTrie.ROOT,
+                               next_ngram="",
                                unused_enums=lengths, soln="",
                                preferences=preferences, dicts=dicts,
                                solutions=solutions)
@@ -137,8 +130,7 @@ def _FindSequencesMissingAnNgram(ngrams, lengths, preferences):
 
 
 def _FindSequencesAllNgrams(ngrams, lengths, preferences):
-    words  = _LoadWords(preferences.dict_file)
-    dicts = Dicts(words=words, prefixes=_WordPrefixes(words))
+    dicts = Dicts(words=WordTrie(_LoadWords(preferences.dict_file)))
  
     solutions = set()
 
@@ -149,12 +141,14 @@ def _FindSequencesAllNgrams(ngrams, lengths, preferences):
         else:
             extracted_ngrams = _ExtractLongWords(ngrams, lengths,
                                                  preferences, dicts)
-            _FindEnumeratedSeq(new_word="", next_ngram="", unused_ngrams=ngrams,
+            _FindEnumeratedSeq(new_word="", word_node=WordTrie.ROOT,
+                               next_ngram="", unused_ngrams=ngrams,
                                unused_enums=lengths, soln="",
                                preferences=preferences, dicts=dicts,
                                solutions=solutions)
     else:
-        _FindSeq(new_word="", next_ngram="", unused_ngrams=ngrams, soln="",
+        _FindSeq(new_word="", word_node=WordTrie.ROOT, next_ngram="",
+                 unused_ngrams=ngrams, soln="",
                  preferences=preferences, dicts=dicts, solutions=solutions)
     return solutions
 
@@ -172,27 +166,26 @@ def _FindPossiblyOffsetSeq(ngrams, lengths, preferences, dicts, solutions):
             mod_ngrams.remove(ngram)
             mod_ngrams.append(ngram[c:])
 
-            _FindEnumeratedSeq(new_word="", next_ngram="",
+            _FindEnumeratedSeq(new_word="", word_node=WordTrie.ROOT,
+                               next_ngram="",
                                unused_ngrams=mod_ngrams,
                                unused_enums=lengths,
                                soln="",
                                preferences=preferences, dicts=dicts,
                                solutions=solutions)
 
-def _FindEnumeratedSeq(new_word, next_ngram, unused_ngrams, unused_enums,
-        soln, preferences, dicts, solutions):
+def _FindEnumeratedSeq(new_word, word_node, next_ngram, unused_ngrams,
+        unused_enums, soln, preferences, dicts, solutions):
     """Complete new_word using some/all of next_ngram and then continue
        finding a solution using all the unused_ngrams. All of next_ngram
        must be consumed before taking another unused_ngram.
 
        new_word:       the next word being constructed
+       word_node:      the node of dicts.words that new_word leads to
        next_ngram:     the next ngram to use
        unused_ngrams:  a set of ngrams, all of which must be used
        unused_enums:   an ordered list of word length enumerations
        soln:           the solution string thus far
-
-       words:          all the words in the dictionary
-       word_prefixes:  all character strings that can be extended to make a word
     """
     if not unused_enums:
         solutions.add(soln[1:]) # Eliminate leading word separator
@@ -205,19 +198,22 @@ def _FindEnumeratedSeq(new_word, next_ngram, unused_ngrams, unused_enums,
     if next_ngram:
         if len(new_word) + len(next_ngram) < next_word_len:
             # Extend new_word by all of next_ngram
-            if not new_word+next_ngram in dicts.prefixes:
+            next_node = dicts.words.Walk(word_node, next_ngram)
+            if not dicts.words.IsPrefix(next_node):
                 return
             new_word += preferences.ngram_separator + next_ngram
-            _FindEnumeratedSeq(new_word, "", unused_ngrams, unused_enums, soln,
-                               preferences, dicts, solutions)
+            _FindEnumeratedSeq(new_word, next_node, "", unused_ngrams,
+                               unused_enums, soln, preferences, dicts,
+                               solutions)
         else:
             # Complete new_word with some or all of next_ngram
             n_letters = next_word_len - len(new_word)
+            if not dicts.words.IsWord(
+                    dicts.words.Walk(word_node, next_ngram[:n_letters])):
+                return
             word = (new_word + preferences.ngram_separator 
                     + next_ngram[:n_letters])
-            if not word in dicts.words:
-                return
-            _FindEnumeratedSeq("", next_ngram[n_letters:],
+            _FindEnumeratedSeq("", WordTrie.ROOT, next_ngram[n_letters:],
                                unused_ngrams, unused_enums[1:],
                                soln + preferences.word_separator + word, 
                                preferences, dicts, solutions)
@@ -225,36 +221,41 @@ def _FindEnumeratedSeq(new_word, next_ngram, unused_ngrams, unused_enums,
         for ngram in unused_ngrams:
             ngrams = unused_ngrams.copy()
             ngrams.remove(ngram)
-            _FindEnumeratedSeq(new_word, ngram, ngrams, unused_enums, soln,
-                               preferences, dicts, solutions)
+            _FindEnumeratedSeq(new_word, word_node, ngram, ngrams,
+                               unused_enums, soln, preferences, dicts,
+                               solutions)
 
 
 # This finds too many solutions.  Enumerations are usually necessary.
-def _FindSeq(new_word, next_ngram, unused_ngrams, soln, preferences, dicts,
-             solutions):
+def _FindSeq(new_word, word_node, next_ngram, unused_ngrams, soln, preferences,
+             dicts, solutions):
     """Complete new_word using some/all of next_ngram and then continue
        finding a solution using all the unused_ngrams. All of next_ngram
        must be consumed before taking another unused_ngram.
 
        new_word:       the next word being constructed
+       word_node:      the node of dicts.words that new_word leads to
        next_ngram:     the next ngram to use
        unused_ngrams:  a set of ngrams, all of which must be used
        soln:           the solution string thus far
-
-       words:          all the words in the dictionary
-       word_prefixes:  all character strings that can be extended to make a word
     """
     if next_ngram:
         # Try to create a new _partial_ word by extending new_word by next_ngram
-        if new_word + next_ngram in dicts.prefixes:
+        next_node = dicts.words.Walk(word_node, next_ngram)
+        if dicts.words.IsPrefix(next_node):
             _FindSeq(new_word + preferences.ngram_separator + next_ngram, 
-                     "", unused_ngrams, soln, preferences, dicts, solutions)
+                     next_node, "", unused_ngrams, soln, preferences, dicts,
+                     solutions)
 
         # Find a word made from new_word and some leading piece of next_ngram
+        node = word_node
         for i in range(len(next_ngram)):
-            word = new_word + next_ngram[:i+1]
-            if word in dicts.words:
-                _FindSeq("", next_ngram[i+1:], unused_ngrams, 
+            node = dicts.words.Walk(node, next_ngram[i])
+            if node is None:
+                break
+            if dicts.words.IsWord(node):
+                word = new_word + next_ngram[:i+1]
+                _FindSeq("", WordTrie.ROOT, next_ngram[i+1:], unused_ngrams, 
                          soln + preferences.word_separator + word,
                          preferences, dicts, solutions)
         # Fail
@@ -270,7 +271,8 @@ def _FindSeq(new_word, next_ngram, unused_ngrams, soln, preferences, dicts,
     for ngram in unused_ngrams:
         ngrams = unused_ngrams.copy()
         ngrams.remove(ngram)
-        _FindSeq(new_word, ngram, ngrams, soln, preferences, dicts, solutions)
+        _FindSeq(new_word, word_node, ngram, ngrams, soln, preferences, dicts,
+                 solutions)
 
 
 def _VerifyNgramAndEnumLengthsOrDie(ngrams, lengths, allow_shorter_lengths, drop_one_ngram):
@@ -0,0 +1,47 @@
+#!/usr/bin/python3
+"""Tests for battleships.py.  Run with: python3 -m unittest test_battleships"""
+
+import json
+import unittest
+
+import battleships
+
+
+def _Solve(puzzle):
+  line = puzzle if isinstance(puzzle, str) else json.dumps(puzzle)
+  return battleships._SolvePuzzleLine(("test:1", line), max_solutions=0,
+                                      count_only=False)
+
+
+class MalformedPuzzleLineTest(unittest.TestCase):
+
+  def assertError(self, puzzle):
+    result = _Solve(puzzle)
+    self.assertIn("error", result, result)
+    self.assertNotIn("count", result)
+
+  def testEmptyBoard(self):
+    self.assertError({"rows": [], "cols": [], "ships": [1]})
+    self.assertError({"rows": [1], "cols": [], "ships": [1]})
+    self.assertError({"rows": [], "cols": [1], "ships": [1]})
+
+  def testShipTooShort(self):
+    self.assertError({"rows": [0, 0], "cols": [0, 0], "ships": [0]})
+    self.assertError({"rows": [1, 0], "cols": [1, 0], "ships": [1, -1]})
+
+  def testBadLines(self):
+    self.assertError("not json")
+    self.assertError({"rows": [1, 0], "ships": [1]})
+    self.assertError({"rows": [1, 0], "cols": [1, 0], "ships": [1],
+                      "grid": ["--"]})
+
+  def testGoodLineAfterBadOnes(self):
+    self.assertError({"rows": [], "cols": [], "ships": [1]})
+    result = _Solve({"name": "ok", "rows": [1, 0], "cols": [1, 0],
+                     "ships": [1]})
+    self.assertEqual("ok", result["name"])
+    self.assertEqual(1, result["count"])
+
+
+if __name__ == "__main__":
+  unittest.main()
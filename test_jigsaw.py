@@ -0,0 +1,71 @@
+#!/usr/bin/python3
+"""Tests for jigsaw.py.  Run with: python3 -m unittest test_jigsaw"""
+
+import unittest
+
+import jigsaw
+
+# The 'b' monomino and the 'b' tromino draw the same grid side by side,
+# and the 'A' tromino is the same shape as the 'b' one.
+SHARED_CHAR_PIECES = [["b"], [" b", "bb"], ["AA", "A "]]
+SHARED_CHAR_GRIDS = [["    ", "   x"], ["x   ", "    "]]
+
+
+def _Count(pieces, grid, **kwargs):
+  return sum(count for rows, count in jigsaw.Solutions(pieces, grid, **kwargs))
+
+def _Grids(pieces, grid, **kwargs):
+  return sorted(rows for rows, count in jigsaw.Solutions(pieces, grid, **kwargs)
+                if rows)
+
+
+class SharedDrawCharTest(unittest.TestCase):
+
+  def testCountsMatchCountOnly(self):
+    for grid in SHARED_CHAR_GRIDS:
+      expected = _Count(SHARED_CHAR_PIECES, grid, count_only=True)
+      self.assertEqual(6, expected)
+      for kwargs in ({}, {"dancing_links": True},
+                     {"dancing_links": True, "count_only": True},
+                     {"expand": True}):
+        self.assertEqual(expected, _Count(SHARED_CHAR_PIECES, grid, **kwargs),
+                         (grid, kwargs))
+
+  def testFillAndDancingLinksDrawTheSameGrids(self):
+    for grid in SHARED_CHAR_GRIDS:
+      self.assertEqual(_Grids(SHARED_CHAR_PIECES, grid),
+                       _Grids(SHARED_CHAR_PIECES, grid, dancing_links=True))
+
+  def testGridsAreDrawnOnce(self):
+    grids = _Grids(SHARED_CHAR_PIECES, SHARED_CHAR_GRIDS[0])
+    self.assertEqual(len(set(grids)), len(grids))
+
+  def testMaxSolutionsCountsRepeatedGrids(self):
+    grid = SHARED_CHAR_GRIDS[0]
+    self.assertEqual(jigsaw.CountSolutions(SHARED_CHAR_PIECES, grid,
+                                           max_solutions=5), 5)
+    self.assertEqual(_Count(SHARED_CHAR_PIECES, grid, max_solutions=5), 5)
+
+  def testDistinctCharsDrawEveryTiling(self):
+    pieces = [["a"], ["bb"], ["c", "c"]]
+    classes = jigsaw._ShapeClasses(pieces, True, False)
+    self.assertFalse(jigsaw._SharesDrawChars(classes))
+    self.assertTrue(jigsaw._SharesDrawChars(
+        jigsaw._ShapeClasses(SHARED_CHAR_PIECES, True, False)))
+    solutions = list(jigsaw.Solutions(pieces, ["   ", "  x"]))
+    self.assertTrue(solutions)
+    self.assertTrue(all(rows for rows, count in solutions))
+
+
+class PieceSizeTest(unittest.TestCase):
+
+  def testPiecesMustFillTheGrid(self):
+    for kwargs in ({}, {"dancing_links": True}, {"count_only": True}):
+      with self.assertRaises(ValueError):
+        jigsaw.Solutions([["a"], ["b"], ["c"]], ["  "], **kwargs)
+      with self.assertRaises(ValueError):
+        jigsaw.Solutions([["a"]], ["  "], **kwargs)
+
+
+if __name__ == "__main__":
+  unittest.main()
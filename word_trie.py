@@ -0,0 +1,77 @@
+"""A compact trie for looking up words and word prefixes.
+
+Shared by the word puzzle solvers, which need to know if a string is a word
+and if it can be extended into a longer one.  A set of every prefix of every
+word takes hundreds of MB for the bigger dictionaries.  The trie holds one
+character and a few integers per prefix in flat arrays instead.
+
+Works with Python 2 and 3.
+"""
+
+from array import array
+from bisect import bisect_left
+
+
+class WordTrie(object):
+    """The trie of a collection of words.
+
+    Nodes are numbered, ROOT being the empty string.  The children of a node
+    are numbered consecutively, and chars holds the character leading to each
+    node, so a child is found by searching the node's run of chars.
+
+    Lookups are incremental: Walk() carries on from any node, so a search
+    that builds a string a piece at a time only looks up the new piece.
+    """
+
+    ROOT = 0
+
+    def __init__(self, words):
+        words = sorted(set(words))
+        chars = [' ']  # The root isn't reached by a character.
+        self._first = array('i', [0])  # The first child of each node.
+        self._end = array('i', [0])    # One past the last child.
+        self._final = bytearray(1)     # 1 if the node is a word.
+
+        # (node, lo, hi, depth): words[lo:hi] all start with the depth
+        # characters leading to node.
+        todo = [(self.ROOT, 0, len(words), 0)]
+        while todo:
+            node, lo, hi, depth = todo.pop()
+            # Sorting puts the word that ends here first.
+            if lo < hi and len(words[lo]) == depth:
+                self._final[node] = 1
+                lo += 1
+            self._first[node] = len(chars)
+            while lo < hi:
+                c = words[lo][depth]
+                # Words starting with the prefix sort before the prefix with
+                # its last character bumped.
+                bumped = words[lo][:depth] + chr(ord(c) + 1)
+                next_lo = bisect_left(words, bumped, lo, hi)
+                todo.append((len(chars), lo, next_lo, depth + 1))
+                chars.append(c)
+                self._first.append(0)
+                self._end.append(0)
+                self._final.append(0)
+                lo = next_lo
+            self._end[node] = len(chars)
+        self._chars = ''.join(chars)
+
+    def Walk(self, node, string):
+        """Returns the node reached by following string from node, or None
+        if no word continues that way."""
+        for c in string:
+            node = self._chars.find(c, self._first[node], self._end[node])
+            if node < 0:
+                return None
+        return node
+
+    def IsWord(self, node):
+        return node is not None and self._final[node] == 1
+
+    def IsPrefix(self, node):
+        """True if node's string can be extended into a longer word."""
+        return node is not None and self._end[node] > self._first[node]
+
+    def __contains__(self, word):
+        return self.IsWord(self.Walk(self.ROOT, word))